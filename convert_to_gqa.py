@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Convert a joint attention checkpoint to grouped-query attention.
+
+The key and value projections of the decoder self attention layers are
+mean-pooled over groups of consecutive heads (Ainslie et al., 2023). The
+converted model should be uptrained for a small fraction of the original
+number of updates, see local_joint_attention_wmt_en_de_big_gqa.sh.
+"""
+
+import argparse
+import re
+
+import torch
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Convert a checkpoint to grouped-query attention.')
+    # fmt: off
+    parser.add_argument('--input', required=True, metavar='FILE',
+                        help='input checkpoint')
+    parser.add_argument('--output', required=True, metavar='FILE',
+                        help='output checkpoint')
+    parser.add_argument('--kv-heads', required=True, type=int, metavar='N',
+                        help='number of key/value heads of the converted model')
+    # fmt: on
+    return parser
+
+
+def pool_heads(proj, num_kv_heads, kv_heads):
+    """Average the rows of a key or value projection over groups of heads."""
+    group = num_kv_heads // kv_heads
+    pooled = proj.float().view(kv_heads, group, -1, *proj.size()[1:]).mean(dim=1)
+    return pooled.reshape(-1, *proj.size()[1:]).type_as(proj)
+
+
+def convert_state_dict(state_dict, embed_dim, num_heads, num_kv_heads, kv_heads):
+    """Pool the key/value heads of every decoder self attention in place.
+
+    *num_kv_heads* is the current number of key/value heads and *kv_heads*
+    the number of heads after the conversion. Returns the number of converted
+    parameters.
+    """
+    kv_dim = embed_dim // num_heads * num_kv_heads
+    pattern = re.compile(r'decoder\.layers\.\d+\.self_attn\.in_proj_(weight|bias)$')
+    converted = 0
+    for key, value in state_dict.items():
+        if pattern.search(key):
+            assert value.size(0) == embed_dim + 2 * kv_dim, \
+                "unexpected size {} for {}".format(tuple(value.size()), key)
+            q, k, v = value.split([embed_dim, kv_dim, kv_dim], dim=0)
+            state_dict[key] = torch.cat((
+                q, pool_heads(k, num_kv_heads, kv_heads), pool_heads(v, num_kv_heads, kv_heads),
+            ), dim=0)
+            converted += 1
+    return converted
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    print(args)
+
+    state = torch.load(args.input, map_location='cpu')
+    model_args = state['args']
+    num_heads = model_args.decoder_attention_heads
+    num_kv_heads = getattr(model_args, 'decoder_kv_heads', None) or num_heads
+    assert getattr(model_args, 'decoder_attention_heads_list', None) is None, \
+        "convert the model before pruning its heads"
+    assert num_kv_heads % args.kv_heads == 0, \
+        "--kv-heads must divide the current number of key/value heads ({})".format(num_kv_heads)
+
+    converted = convert_state_dict(
+        state['model'], model_args.decoder_embed_dim, num_heads, num_kv_heads, args.kv_heads,
+    )
+    model_args.decoder_kv_heads = args.kv_heads
+    print('| pooled {} key/value heads into {} in {} parameters'.format(num_kv_heads, args.kv_heads, converted))
+    torch.save(state, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Multiprocess replacement for prepare-iwslt14-31K.sh and prepare-wmt14en2fr.sh.
+
+Tag stripping, punctuation normalization, tokenization, lowercasing, length/ratio
+cleaning and BPE are applied in parallel chunks of lines with the Python ports
+of the Moses scripts (sacremoses) and subword-nmt, producing the same files as
+the shell recipes. With --destdir the result is also binarized with
+fairseq-preprocess.
+
+Requires: pip install sacremoses subword-nmt
+"""
+
+import argparse
+import collections
+import gzip
+import itertools
+import multiprocessing
+import os
+import re
+import shutil
+import tarfile
+import unicodedata
+import urllib.request
+
+RECIPES = {
+    'iwslt14': {
+        'src': 'de',
+        'tgt': 'en',
+        'prep': 'iwslt14.tokenized.31K.de-en',
+        'bpe_tokens': 31000,
+        'urls': ['https://wit3.fbk.eu/archive/2014-01/texts/de/en/de-en.tgz'],
+    },
+    'wmt14en2fr': {
+        'src': 'en',
+        'tgt': 'fr',
+        'prep': 'wmt14_en_fr',
+        'bpe_tokens': 40000,
+        'urls': [
+            'http://statmt.org/wmt13/training-parallel-europarl-v7.tgz',
+            'http://statmt.org/wmt13/training-parallel-commoncrawl.tgz',
+            'http://statmt.org/wmt13/training-parallel-un.tgz',
+            'http://statmt.org/wmt14/training-parallel-nc-v9.tgz',
+            'http://statmt.org/wmt10/training-giga-fren.tar',
+            'http://statmt.org/wmt14/test-full.tgz',
+        ],
+        'corpora': [
+            'training/europarl-v7.fr-en',
+            'commoncrawl.fr-en',
+            'un/undoc.2000.fr-en',
+            'training/news-commentary-v9.fr-en',
+            'giga-fren.release2.fixed',
+        ],
+    },
+}
+
+IWSLT_SKIP_TAGS = ('<url>', '<talkid>', '<keywords>')
+IWSLT_STRIP_TAGS = re.compile(r'</?(title|description)>')
+SEG_OPEN = re.compile(r'<seg id="[0-9]*">\s*')
+SEG_CLOSE = re.compile(r'\s*</seg>\s*')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Parallel data preparation for the joint attention recipes.')
+    # fmt: off
+    parser.add_argument('recipe', choices=sorted(RECIPES.keys()), help='dataset to prepare')
+    parser.add_argument('--orig', default='orig', help='directory with the downloaded corpora')
+    parser.add_argument('--prep', default=None, help='output directory (default: recipe name)')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of processes')
+    parser.add_argument('--chunk-size', type=int, default=10000, metavar='N',
+                        help='lines sent to a worker at a time')
+    parser.add_argument('--no-download', action='store_true',
+                        help='expect the corpora to be already extracted in --orig')
+    parser.add_argument('--destdir', default=None,
+                        help='also binarize the result with fairseq-preprocess into this directory')
+    # fmt: on
+    return parser
+
+
+# Worker side. Tokenizers and BPE models are built once per process.
+
+_tokenizers = {}
+_normalizers = {}
+_bpe = {}
+
+
+def _tokenizer(lang):
+    if lang not in _tokenizers:
+        from sacremoses import MosesTokenizer
+        _tokenizers[lang] = MosesTokenizer(lang=lang)
+    return _tokenizers[lang]
+
+
+def _normalizer(lang):
+    if lang not in _normalizers:
+        from sacremoses import MosesPunctNormalizer
+        _normalizers[lang] = MosesPunctNormalizer(lang=lang, perl_parity=True)
+    return _normalizers[lang]
+
+
+def _bpe_model(codes):
+    if codes not in _bpe:
+        from subword_nmt.apply_bpe import BPE
+        with open(codes, encoding='utf-8') as f:
+            _bpe[codes] = BPE(f)
+    return _bpe[codes]
+
+
+def remove_non_printing_char(line):
+    """Python version of remove-non-printing-char.perl."""
+    return ''.join(' ' if unicodedata.category(c).startswith('C') else c for c in line)
+
+
+def process_line(line, lang, normalize=False, aggressive=False, lowercase=False, bpe_codes=None):
+    """Apply the per-line steps of the recipes in the same order as the shell scripts."""
+    if normalize:
+        line = _normalizer(lang).normalize(line)
+        line = remove_non_printing_char(line)
+    if lang is not None:
+        line = _tokenizer(lang).tokenize(line, aggressive_dash_splits=aggressive, return_str=True, escape=True)
+    if lowercase:
+        line = line.lower()
+    if bpe_codes is not None:
+        line = _bpe_model(bpe_codes).process_line(line)
+    return line
+
+
+def _process_chunk(job):
+    lines, kwargs = job
+    return [process_line(line, **kwargs) for line in lines]
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Pipeline(object):
+    """Ordered, streaming map of :func:`process_line` over a pool of processes.
+
+    At most *max_pending* chunks (by default two per worker) are read ahead
+    and queued, so memory does not grow with the size of the corpus.
+    """
+
+    def __init__(self, workers, chunk_size, max_pending=None):
+        self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 2 * workers
+
+    def map(self, lines, **kwargs):
+        jobs = ((chunk, kwargs) for chunk in chunks(lines, self.chunk_size))
+        if self.pool is None:
+            for job in jobs:
+                yield from _process_chunk(job)
+            return
+        pending = collections.deque()
+        for job in jobs:
+            if len(pending) >= self.max_pending:
+                yield from pending.popleft().get()
+            pending.append(self.pool.apply_async(_process_chunk, (job,)))
+        while pending:
+            yield from pending.popleft().get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+# Main process side.
+
+def read_lines(path):
+    if not os.path.exists(path) and os.path.exists(path + '.gz'):
+        path += '.gz'
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='\n') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def write_lines(path, lines):
+    with open(path, 'w', encoding='utf-8', newline='\n') as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+def clean_pair(src, tgt, ratio, min_len, max_len, max_word_length=1000):
+    """Python version of the filtering in clean-corpus-n.perl. Returns ``None``
+    for dropped pairs."""
+    cleaned = []
+    for line in (src, tgt):
+        line = re.sub(r'\s+', ' ', line.replace('|', '')).strip(' ')
+        if line == '':
+            return None
+        cleaned.append(line)
+    src_count, tgt_count = (len(line.split(' ')) for line in cleaned)
+    if not (min_len <= src_count <= max_len and min_len <= tgt_count <= max_len):
+        return None
+    if src_count / tgt_count > ratio or tgt_count / src_count > ratio:
+        return None
+    word = re.compile(r'[^\s|]{%d}' % (max_word_length + 1))
+    if any(word.search(line) for line in cleaned):
+        return None
+    return cleaned
+
+
+def clean_corpus(prefix, src, tgt, out_prefix, ratio, min_len, max_len):
+    pairs = zip(read_lines('{}.{}'.format(prefix, src)), read_lines('{}.{}'.format(prefix, tgt)))
+    with open('{}.{}'.format(out_prefix, src), 'w', encoding='utf-8') as fsrc, \
+            open('{}.{}'.format(out_prefix, tgt), 'w', encoding='utf-8') as ftgt:
+        for pair in pairs:
+            cleaned = clean_pair(*pair, ratio=ratio, min_len=min_len, max_len=max_len)
+            if cleaned is not None:
+                fsrc.write(cleaned[0] + '\n')
+                ftgt.write(cleaned[1] + '\n')
+
+
+def split_valid(path, valid_path, train_path, every):
+    """Send every N-th line (1-based) to the validation set, like the awk calls."""
+    with open(valid_path, 'w', encoding='utf-8') as fvalid, open(train_path, 'w', encoding='utf-8') as ftrain:
+        for i, line in enumerate(read_lines(path), start=1):
+            (fvalid if i % every == 0 else ftrain).write(line + '\n')
+
+
+def sgm_segments(path):
+    for line in read_lines(path):
+        if '<seg id' in line:
+            line = SEG_OPEN.sub('', line)
+            line = SEG_CLOSE.sub('', line)
+            yield line.replace('’', "'")
+
+
+def iwslt_train_lines(path):
+    for line in read_lines(path):
+        if any(tag in line for tag in IWSLT_SKIP_TAGS):
+            continue
+        yield IWSLT_STRIP_TAGS.sub('', line)
+
+
+def download(urls, orig):
+    os.makedirs(orig, exist_ok=True)
+    for url in urls:
+        path = os.path.join(orig, os.path.basename(url))
+        if os.path.exists(path):
+            print('{} already exists, skipping download'.format(path))
+            continue
+        print('Downloading data from {}...'.format(url))
+        urllib.request.urlretrieve(url, path)
+        with tarfile.open(path) as tar:
+            tar.extractall(orig)
+
+
+def learn_and_apply_bpe(pipeline, tmp, src, tgt, bpe_code, bpe_tokens, outputs):
+    from subword_nmt.learn_bpe import learn_bpe
+
+    train = os.path.join(tmp, 'train.{}-{}'.format(tgt, src))
+    write_lines(train, itertools.chain(
+        read_lines(os.path.join(tmp, 'train.' + src)), read_lines(os.path.join(tmp, 'train.' + tgt))))
+
+    print('learn_bpe on {}...'.format(train))
+    with open(train, encoding='utf-8') as fin, open(bpe_code, 'w', encoding='utf-8') as fout:
+        learn_bpe(fin, fout, bpe_tokens)
+
+    for lang in (src, tgt):
+        for split in ('train', 'valid', 'test'):
+            name = '{}.{}'.format(split, lang)
+            print('apply_bpe to {}...'.format(name))
+            write_lines(outputs(name), pipeline.map(
+                read_lines(os.path.join(tmp, name)), lang=None, bpe_codes=bpe_code))
+
+
+def prepare_iwslt14(args, cfg, pipeline):
+    src, tgt, lang = cfg['src'], cfg['tgt'], '{}-{}'.format(cfg['src'], cfg['tgt'])
+    prep = args.prep
+    tmp = os.path.join(prep, 'tmp')
+    orig = os.path.join(args.orig, lang)
+
+    print('pre-processing train data...')
+    for l in (src, tgt):
+        lines = iwslt_train_lines(os.path.join(orig, 'train.tags.{}.{}'.format(lang, l)))
+        write_lines(os.path.join(tmp, 'train.tags.{}.tok.{}'.format(lang, l)),
+                    pipeline.map(lines, lang=l, lowercase=True))
+    clean_corpus(os.path.join(tmp, 'train.tags.{}.tok'.format(lang)), src, tgt,
+                 os.path.join(tmp, 'train.tags.{}'.format(lang)), ratio=1.5, min_len=1, max_len=175)
+
+    print('pre-processing valid/test data...')
+    test_sets = ['IWSLT14.TED.dev2010', 'IWSLT14.TEDX.dev2012', 'IWSLT14.TED.tst2010',
+                 'IWSLT14.TED.tst2011', 'IWSLT14.TED.tst2012']
+    for l in (src, tgt):
+        for name in test_sets:
+            lines = sgm_segments(os.path.join(orig, '{}.{}.{}.xml'.format(name, lang, l)))
+            write_lines(os.path.join(tmp, '{}.{}.{}'.format(name, lang, l)),
+                        pipeline.map(lines, lang=l, lowercase=True))
+
+    print('creating train, valid, test...')
+    for l in (src, tgt):
+        split_valid(os.path.join(tmp, 'train.tags.{}.{}'.format(lang, l)),
+                    os.path.join(tmp, 'valid.' + l), os.path.join(tmp, 'train.' + l), every=23)
+        write_lines(os.path.join(tmp, 'test.' + l), itertools.chain.from_iterable(
+            read_lines(os.path.join(tmp, '{}.{}.{}'.format(name, lang, l))) for name in test_sets))
+
+    learn_and_apply_bpe(pipeline, tmp, src, tgt, os.path.join(prep, 'code'), cfg['bpe_tokens'],
+                        outputs=lambda name: os.path.join(prep, name))
+
+
+def prepare_wmt14en2fr(args, cfg, pipeline):
+    src, tgt, lang = cfg['src'], cfg['tgt'], '{}-{}'.format(cfg['src'], cfg['tgt'])
+    prep = args.prep
+    tmp = os.path.join(prep, 'tmp')
+
+    print('pre-processing train data...')
+    for l in (src, tgt):
+        lines = itertools.chain.from_iterable(
+            read_lines(os.path.join(args.orig, '{}.{}'.format(corpus, l))) for corpus in cfg['corpora'])
+        write_lines(os.path.join(tmp, 'train.tags.{}.tok.{}'.format(lang, l)),
+                    pipeline.map(lines, lang=l, normalize=True, aggressive=True))
+
+    print('pre-processing test data...')
+    for l in (src, tgt):
+        t = 'src' if l == src else 'ref'
+        lines = sgm_segments(os.path.join(args.orig, 'test-full', 'newstest2014-fren-{}.{}.sgm'.format(t, l)))
+        write_lines(os.path.join(tmp, 'test.' + l), pipeline.map(lines, lang=l, aggressive=True))
+
+    print('splitting train and valid...')
+    for l in (src, tgt):
+        split_valid(os.path.join(tmp, 'train.tags.{}.tok.{}'.format(lang, l)),
+                    os.path.join(tmp, 'valid.' + l), os.path.join(tmp, 'train.' + l), every=1333)
+
+    learn_and_apply_bpe(pipeline, tmp, src, tgt, os.path.join(prep, 'code'), cfg['bpe_tokens'],
+                        outputs=lambda name: os.path.join(tmp, 'bpe.' + name))
+
+    for split in ('train', 'valid'):
+        clean_corpus(os.path.join(tmp, 'bpe.' + split), src, tgt, os.path.join(prep, split),
+                     ratio=1.5, min_len=1, max_len=250)
+    for l in (src, tgt):
+        shutil.copyfile(os.path.join(tmp, 'bpe.test.' + l), os.path.join(prep, 'test.' + l))
+
+
+def binarize(args, cfg):
+    from fairseq import options
+    from fairseq_cli import preprocess
+
+    parser = options.get_preprocessing_parser()
+    prefix = os.path.join(args.prep, '{}')
+    preprocess.main(parser.parse_args([
+        '--joined-dictionary', '--source-lang', cfg['src'], '--target-lang', cfg['tgt'],
+        '--trainpref', prefix.format('train'), '--validpref', prefix.format('valid'),
+        '--testpref', prefix.format('test'), '--destdir', args.destdir,
+        '--workers', str(args.workers),
+    ]))
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    print(args)
+
+    cfg = RECIPES[args.recipe]
+    args.prep = args.prep or cfg['prep']
+    os.makedirs(os.path.join(args.prep, 'tmp'), exist_ok=True)
+    if not args.no_download:
+        download(cfg['urls'], args.orig)
+
+    pipeline = Pipeline(args.workers, args.chunk_size)
+    try:
+        if args.recipe == 'iwslt14':
+            prepare_iwslt14(args, cfg, pipeline)
+        else:
+            prepare_wmt14en2fr(args, cfg, pipeline)
+    finally:
+        pipeline.close()
+
+    if args.destdir is not None:
+        binarize(args, cfg)
+
+
+if __name__ == '__main__':
+    main()
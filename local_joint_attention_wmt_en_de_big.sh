@@ -38,5 +38,5 @@ python scripts/average_checkpoints.py --inputs $SAVE \
 
 # Evaluation
 CUDA_VISIBLE_DEVICES=0 fairseq-generate $DATA --path "${SAVE}/checkpoint_last10_avg.pt" --batch-size 32 --beam 5 \
-    --user-dir models --remove-bpe --lenpen 0.35 --gen-subset test > wmt16_gen.txt
-bash scripts/compound_split_bleu.sh wmt16_gen.txt
+    --user-dir models --remove-bpe --lenpen 0.35 --gen-subset test \
+    | python score.py --generate-output --compound-split
@@ -0,0 +1,47 @@
+#!/bin/bash
+
+#SBATCH --job-name=wmt14_en_de_gqa
+#SBATCH --gres=gpu:8
+#SBATCH --cpus-per-task 1   # Number of CPUs per task
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=8
+#SBATCH --mem=30G           # CPU memory per node
+
+# Grouped-query attention: convert the averaged checkpoint trained with
+# local_joint_attention_wmt_en_de_big.sh to 4 key/value heads (16 query heads)
+# and uptrain it for 5% of the original number of updates.
+
+KV_HEADS=4
+
+exp=local_joint_attention_wmt_en_de_big
+echo $exp
+
+DATA=data-bin/wmt16_en_de_bpe32k
+BASE="checkpoints/$exp"
+SAVE="checkpoints/${exp}_gqa${KV_HEADS}"
+mkdir -p $SAVE
+
+# Checkpoint conversion (mean-pooling of the key/value heads)
+python convert_to_gqa.py --input "${BASE}/checkpoint_last10_avg.pt" \
+    --output "${SAVE}/checkpoint_converted.pt" --kv-heads $KV_HEADS
+
+# Uptraining
+python -m torch.distributed.launch --nproc_per_node 8 $(which fairseq-train) \
+    $DATA --fp16 --log-interval 100 --no-progress-bar \
+    --restore-file "${SAVE}/checkpoint_converted.pt" \
+    --reset-optimizer --reset-lr-scheduler --reset-dataloader --reset-meters \
+    --max-update 1500 --share-all-embeddings \
+    --optimizer adam --adam-betas '(0.9, 0.98)' \
+    --clip-norm 0.0 --weight-decay 0.0 \
+    --criterion label_smoothed_cross_entropy --label-smoothing 0.1 \
+    --update-freq 32 --keep-last-epochs 5 \
+    --ddp-backend=no_c10d --max-tokens 1800 \
+    --lr-scheduler inverse_sqrt --warmup-init-lr 1e-7 --warmup-updates 150 --lr 0.0002 \
+    --arch local_joint_attention_wmt_en_de_big --decoder-kv-heads $KV_HEADS --save-dir $SAVE \
+    --dropout 0.3 --attention-dropout 0.3 \
+    --user-dir models
+
+# Evaluation
+CUDA_VISIBLE_DEVICES=0 fairseq-generate $DATA --path "${SAVE}/checkpoint_last.pt" --batch-size 32 --beam 5 \
+    --user-dir models --remove-bpe --lenpen 0.35 --gen-subset test \
+    | python score.py --generate-output --compound-split
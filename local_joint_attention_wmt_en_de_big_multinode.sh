@@ -0,0 +1,53 @@
+#!/bin/bash
+
+#SBATCH --job-name=wmt14_en_de
+#SBATCH --gres=gpu:8
+#SBATCH --cpus-per-task 8   # Number of CPUs per task
+#SBATCH --nodes=4
+#SBATCH --ntasks-per-node=8
+#SBATCH --mem=120G          # CPU memory per node
+
+# Multi-node version of local_joint_attention_wmt_en_de_big.sh.
+# One train_sharded.py process per GPU is started by srun. The distributed
+# initialization is inferred from the SLURM environment (--distributed-port).
+# Parameters, gradients and optimizer state are sharded across the
+# 32 workers with PyTorch FSDP (--min-params-to-wrap 0 shards every decoder
+# layer separately), and --update-freq is reduced from 32 to 8 to keep the
+# same effective batch size. FSDP needs bf16 instead of fp16.
+
+exp=local_joint_attention_wmt_en_de_big
+echo $exp
+
+DATA=data-bin/wmt16_en_de_bpe32k
+SAVE="checkpoints/$exp"
+mkdir -p $SAVE
+
+NODES=${SLURM_NNODES:-4}
+GPUS_PER_NODE=8
+UPDATE_FREQ=$((256 / (NODES * GPUS_PER_NODE)))
+
+srun --label python train_sharded.py \
+    $DATA --bf16 --log-interval 100 --no-progress-bar \
+    --distributed-world-size $((NODES * GPUS_PER_NODE)) --distributed-port 12597 \
+    --min-params-to-wrap 0 \
+    --max-update 30000 --share-all-embeddings \
+    --optimizer adam --adam-betas '(0.9, 0.98)' \
+    --clip-norm 0.0 --weight-decay 0.0 \
+    --criterion label_smoothed_cross_entropy --label-smoothing 0.1 \
+    --min-lr 1e-09 --update-freq $UPDATE_FREQ --keep-last-epochs 10 \
+    --max-tokens 1800 \
+    --lr-scheduler cosine --warmup-init-lr 1e-7 --warmup-updates 10000 \
+    --lr-shrink 1 --max-lr 0.0009 --lr 1e-7 --min-lr 1e-9 --warmup-init-lr 1e-07 \
+    --t-mult 1 --lr-period-updates 20000 \
+    --arch local_joint_attention_wmt_en_de_big --save-dir $SAVE \
+    --dropout 0.3 --attention-dropout 0.3 \
+    --user-dir models
+
+# Checkpoint averaging
+python scripts/average_checkpoints.py --inputs $SAVE \
+    --num-epoch-checkpoints 10 --output "${SAVE}/checkpoint_last10_avg.pt"
+
+# Evaluation
+CUDA_VISIBLE_DEVICES=0 fairseq-generate $DATA --path "${SAVE}/checkpoint_last10_avg.pt" --batch-size 32 --beam 5 \
+    --user-dir models --remove-bpe --lenpen 0.35 --gen-subset test \
+    | python score.py --generate-output --compound-split
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Weights memory of a multilingual joint attention model (trained with
+--lang-pairs) compared to one bilingual model per translation direction.
+
+Only the parameters are counted. The key/value cache and the activations
+depend on the batch size and the sentence lengths, not on the number of
+directions a model serves, and are not included.
+"""
+
+import argparse
+
+import torch
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Command-line script for weights memory reports.')
+    # fmt: off
+    parser.add_argument('--path', required=True, metavar='FILE',
+                        help='multilingual checkpoint')
+    parser.add_argument('--directions', type=int, metavar='N',
+                        help='number of translation directions served '
+                             '(default: the number of --lang-pairs of the checkpoint)')
+    # fmt: on
+    return parser
+
+
+def count_parameters(state_dict):
+    """Number of parameters of *state_dict*, counting shared tensors once."""
+    seen = set()
+    num_params = 0
+    for key, value in state_dict.items():
+        if key.endswith('version') or value.data_ptr() in seen:
+            continue
+        seen.add(value.data_ptr())
+        num_params += value.numel()
+    return num_params
+
+
+def format_size(num_params, bytes_per_param):
+    return '{:.1f}MB'.format(num_params * bytes_per_param / 2 ** 20)
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    print(args)
+
+    state = torch.load(args.path, map_location='cpu')
+    model_args, state_dict = state['args'], state['model']
+
+    num_params = count_parameters(state_dict)
+    num_languages = getattr(model_args, 'num_languages', None) or 1
+    lang_pairs = getattr(model_args, 'lang_pairs', None)
+    directions = args.directions or (len(lang_pairs.split(',')) if lang_pairs else 1)
+
+    # a bilingual model has a single language embedding for each side
+    language_params = sum(
+        value.numel() for key, value in state_dict.items() if key.endswith('embed_language')
+    )
+    bilingual_params = num_params - language_params * (num_languages - 1) // num_languages
+
+    print('| multilingual model: {} languages, {} directions'.format(num_languages, directions))
+    print('| {:<28} {:>12} {:>10} {:>10}'.format('weights only', 'params', 'fp32', 'fp16'))
+    rows = [
+        ('1 multilingual model', num_params),
+        ('  language embeddings', language_params),
+        ('1 bilingual model', bilingual_params),
+        ('{} bilingual models'.format(directions), directions * bilingual_params),
+    ]
+    for name, params in rows:
+        print('| {:<28} {:>12} {:>10} {:>10}'.format(
+            name, params, format_size(params, 4), format_size(params, 2)))
+    print('| the multilingual model needs {:.1f}x less memory for its weights '
+          '(the K/V cache and the activations are not counted)'.format(directions * bilingual_params / num_params))
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-from . import joint
+from . import joint, joint_translation
@@ -0,0 +1,142 @@
+"""Iteration-level (continuous) batching for the joint attention models.
+
+fairseq-generate keeps decoding a batch until its longest hypothesis is
+finished. :class:`ContinuousBatchGenerator` instead evicts finished sentences
+from the incremental state after every step, and fills the free slots with new
+requests as soon as their source has been processed, so the batch stays full.
+"""
+import itertools
+
+import torch
+
+from fairseq.data import data_utils
+
+
+class ContinuousBatchGenerator(object):
+    """Greedy decoding of a stream of requests with iteration-level batching.
+
+    Args:
+        model (JointAttentionModel): the model, in eval mode
+        tgt_dict (~fairseq.data.Dictionary): target dictionary
+        max_batch_size (int, optional): maximum number of sentences decoded at
+            the same time (default: 64)
+        max_len_a/b (int, optional): generate sequences of maximum length
+            ``ax + b``, where ``x`` is the source length (default: 0, 200)
+    """
+
+    def __init__(self, model, tgt_dict, max_batch_size=64, max_len_a=0, max_len_b=200):
+        self.model = model
+        self.pad = tgt_dict.pad()
+        self.eos = tgt_dict.eos()
+        self.max_batch_size = max_batch_size
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.max_len = model.max_decoder_positions() - 1
+
+    @torch.no_grad()
+    def generate(self, requests):
+        """Translate *requests*, an iterable of ``(id, src_tokens)``,
+        ``(id, src_tokens, prefix_tokens)`` or ``(id, src_tokens,
+        prefix_tokens, src_lang_id, tgt_lang_id)`` tuples where *src_tokens*
+        is a 1D LongTensor ending with eos, *prefix_tokens* an optional 1D
+        LongTensor with a forced target prefix and the language ids select the
+        language embeddings of models with *--num-languages*. Requests in
+        different directions share the batch.
+
+        Yields ``(id, tokens)`` pairs in the order the translations finish.
+        *tokens* starts with the prefix and ends with eos unless the maximum
+        length was reached.
+        """
+        decoder = self.model.decoder
+        requests = iter(requests)
+        exhausted = False
+        state, tokens, ids, max_lens, lang_ids = None, None, [], None, None
+
+        while True:
+            # admit new requests into the free slots
+            free = self.max_batch_size - len(ids)
+            if free > 0 and not exhausted:
+                new_requests = list(itertools.islice(requests, free))
+                exhausted = len(new_requests) < free
+                if len(new_requests) > 0:
+                    new_ids = [request[0] for request in new_requests]
+                    new_state, new_tokens, new_max_lens, new_lang_ids = self.prefill(
+                        [request[1] for request in new_requests],
+                        [request[2] if len(request) > 2 else None for request in new_requests],
+                        [request[3:5] if len(request) > 3 else None for request in new_requests],
+                    )
+                    if state is None:
+                        state, tokens, max_lens, lang_ids = new_state, new_tokens, new_max_lens, new_lang_ids
+                    else:
+                        decoder.concat_incremental_state_(state, new_state)
+                        tokens = self.concat_tokens(tokens, new_tokens)
+                        max_lens = torch.cat((max_lens, new_max_lens))
+                        if lang_ids is not None:
+                            lang_ids = torch.cat((lang_ids, new_lang_ids))
+                    ids.extend(new_ids)
+            if len(ids) == 0:
+                return
+
+            # evict the finished sentences
+            lengths = tokens.ne(self.pad).sum(dim=1) - 1
+            finished = tokens[:, -1].eq(self.eos) | lengths.ge(max_lens)
+            if finished.any():
+                for i in finished.nonzero().view(-1).tolist():
+                    yield ids[i], tokens[i, -lengths[i]:]
+                active = (~finished).nonzero().view(-1)
+                ids = [ids[i] for i in active.tolist()]
+                if len(ids) == 0:
+                    state, tokens, max_lens, lang_ids = None, None, None, None
+                    continue
+                decoder.reorder_incremental_state(state, active)
+                decoder.trim_incremental_state_(state)
+                tokens, max_lens = self.trim_tokens(tokens.index_select(0, active)), max_lens[active]
+                if lang_ids is not None:
+                    lang_ids = lang_ids.index_select(0, active)
+
+            # decode one step for all the sentences in the batch
+            tokens = torch.cat((tokens, self.step(tokens, state, tgt_lang_id=lang_ids)), dim=1)
+
+    def prefill(self, src_tokens, prefix_tokens, lang_ids):
+        """Process the source and the target prefix of the new requests in
+        parallel and decode their first token. Returns the target language
+        ids, or None if the requests have no language ids."""
+        src_lengths = torch.LongTensor([src.numel() for src in src_tokens])
+        src_tokens = data_utils.collate_tokens(src_tokens, self.pad, self.eos, left_pad=True)
+        prefix_tokens = [
+            torch.cat((src.new_full((1,), self.eos), prefix if prefix is not None else src.new_zeros(0)))
+            for src, prefix in zip(src_tokens, prefix_tokens)
+        ]
+        prefix_tokens = data_utils.collate_tokens(prefix_tokens, self.pad, self.eos, left_pad=True)
+        device = next(self.model.parameters()).device
+        src_tokens, src_lengths, prefix_tokens = src_tokens.to(device), src_lengths.to(device), prefix_tokens.to(device)
+        src_lang_id = tgt_lang_id = None
+        if lang_ids[0] is not None:
+            src_lang_id, tgt_lang_id = torch.LongTensor(lang_ids).to(device).unbind(dim=1)
+
+        encoder_out = self.model.encoder(src_tokens, src_lengths, src_lang_id=src_lang_id, tgt_lang_id=tgt_lang_id)
+        state = {}
+        tokens = torch.cat((prefix_tokens, self.step(prefix_tokens, state, encoder_out)), dim=1)
+        self.model.decoder.make_incremental_state_ragged_(state, encoder_out, prefix_tokens)
+        max_lens = (src_lengths.float() * self.max_len_a + self.max_len_b).long().clamp(max=self.max_len)
+        return state, tokens, max_lens, tgt_lang_id
+
+    def step(self, tokens, state, encoder_out=None, tgt_lang_id=None):
+        if encoder_out is None:
+            # the source is already in the incremental state
+            encoder_out = {'encoder_out': None, 'encoder_padding_mask': None, 'tgt_lang_id': tgt_lang_id}
+        logits, _ = self.model.decoder(tokens, encoder_out, incremental_state=state)
+        logits = logits[:, -1, :]
+        logits[:, self.pad] = -float('inf')
+        return logits.argmax(dim=-1, keepdim=True)
+
+    def concat_tokens(self, tokens, other):
+        width = max(tokens.size(1), other.size(1))
+        return torch.cat([
+            torch.cat((t.new_full((t.size(0), width - t.size(1)), self.pad), t), dim=1)
+            for t in (tokens, other)
+        ], dim=0)
+
+    def trim_tokens(self, tokens):
+        start = int(tokens.eq(self.pad).all(dim=0).long().cumprod(dim=0).sum())
+        return tokens[:, start:]
@@ -0,0 +1,177 @@
+"""Chunked translation of long documents with the joint attention models.
+
+Source and target share the self attention sequence of every layer, so a whole
+document does not fit in the maximum positions of the model and its memory
+grows with the square of its length. :class:`DocumentTranslator` translates
+the document in chunks of whole sentences instead:
+
+- each chunk is extended with *overlap* source tokens of the previous and of
+  the next chunk, which are seen by the local windows of the source but masked
+  for the target, so they are not translated twice;
+- the translation of a chunk continues the translation of the previous one.
+  With *--kernel-size-list*, a decoding step only attends to the last
+  ``kernel_size - 1`` target positions of each layer, so the keys and values
+  of those positions are carried over to the next chunk instead of the whole
+  previous translation. The target positions continue those of the previous
+  chunk, until the next chunk could exceed the maximum target positions of
+  the model; that chunk starts a new translation without the carried
+  positions.
+
+The cached keys and values are bounded by the chunk size, whatever the length
+of the document, and the chunk translations are concatenated in order.
+
+Models trained on single sentences never attended across a sentence
+boundary, so by default the chunks are translated independently
+(``overlap=0``, ``carry_target=False``). The context tokens and the carried
+target positions are meant for models trained on consecutive sentences.
+"""
+import torch
+
+
+class DocumentTranslator(object):
+    """Greedy translation of long documents in overlapping chunks.
+
+    Args:
+        model (JointAttentionModel): the model, in eval mode
+        tgt_dict (~fairseq.data.Dictionary): target dictionary
+        chunk_tokens (int, optional): maximum number of source tokens
+            translated in a chunk. Sentences are only split when they are
+            longer (default: 200)
+        overlap (int, optional): number of source tokens of each neighbouring
+            chunk added as context, e.g. half of the largest kernel size for
+            document-level models (default: 0)
+        carry_target (bool, optional): continue the translation of the
+            previous chunk, only with *--kernel-size-list* (default: False)
+        max_len_a/b (float/int, optional): generate at most ``ax + b`` target
+            tokens for a chunk of ``x`` source tokens (default: 1.2, 10)
+    """
+
+    def __init__(self, model, tgt_dict, chunk_tokens=200, overlap=0, carry_target=False,
+                 max_len_a=1.2, max_len_b=10):
+        self.model = model
+        self.pad = tgt_dict.pad()
+        self.eos = tgt_dict.eos()
+        kernel_size_list = model.decoder.kernel_size_list
+        self.chunk_tokens = chunk_tokens
+        self.overlap = overlap
+        # without local windows every target position would have to be kept,
+        # so the chunks are translated independently
+        self.carry = max(kernel_size_list) - 1 if kernel_size_list is not None and carry_target else 0
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.max_len = model.max_decoder_positions() - 1
+        assert chunk_tokens + 2 * overlap + 1 <= model.encoder.max_positions(), \
+            "chunks with their overlap exceed the maximum source positions"
+        # largest number of cached positions, per row of every layer
+        self.max_cached_positions = 0
+
+    def chunks(self, sentences):
+        """Pack *sentences* into chunks of at most *chunk_tokens* tokens."""
+        chunk, length = [], 0
+        for sentence in sentences:
+            if sentence.numel() > 0 and sentence[-1] == self.eos:
+                sentence = sentence[:-1]
+            if sentence.numel() == 0:
+                continue
+            for piece in sentence.split(self.chunk_tokens):
+                if length + piece.numel() > self.chunk_tokens:
+                    yield torch.cat(chunk)
+                    chunk, length = [], 0
+                chunk.append(piece)
+                length += piece.numel()
+        if len(chunk) > 0:
+            yield torch.cat(chunk)
+
+    @torch.no_grad()
+    def translate(self, sentences, src_lang_id=None, tgt_lang_id=None):
+        """Translate a document given as a list of sentences (1D LongTensors,
+        optionally ending with eos). The language ids select the language
+        embeddings of models with *--num-languages*.
+
+        Returns the translation of the whole document as a 1D LongTensor
+        ending with eos.
+        """
+        decoder = self.model.decoder
+        chunks = list(self.chunks(sentences))
+        if len(chunks) == 0:
+            return torch.LongTensor([self.eos])
+        device = next(self.model.parameters()).device
+        if src_lang_id is not None:
+            src_lang_id, tgt_lang_id = torch.LongTensor([src_lang_id]), torch.LongTensor([tgt_lang_id])
+            src_lang_id, tgt_lang_id = src_lang_id.to(device), tgt_lang_id.to(device)
+
+        # number of target positions of the previous chunks that the
+        # translation of this chunk continues
+        output, carry, offset = [], None, 0
+        for i, chunk in enumerate(chunks):
+            left = chunks[i - 1][-self.overlap:] if i > 0 and self.overlap > 0 else chunk.new_zeros(0)
+            right = chunks[i + 1][:self.overlap] if i + 1 < len(chunks) and self.overlap > 0 else chunk.new_zeros(0)
+            state = self.prefill(left, chunk, right, src_lang_id, tgt_lang_id)
+            max_len = min(int(chunk.numel() * self.max_len_a + self.max_len_b), self.max_len)
+            # the positions of this chunk go up to offset + max_len
+            if carry is not None and offset + max_len <= self.max_len + 1:
+                decoder.extend_incremental_state_(state, carry)
+            else:
+                offset = 0
+
+            tokens = chunk.new_full((1, 1), self.eos).to(device)
+            while True:
+                tokens = torch.cat((tokens, self.step(tokens, state, tgt_lang_id, offset)), dim=1)
+                self.max_cached_positions = max(
+                    self.max_cached_positions, decoder.get_ragged_state(state)['key_padding_mask'].size(1))
+                if tokens[0, -1] == self.eos or tokens.size(1) > max_len:
+                    break
+            translation = tokens[0, 1:]
+            if translation[-1] == self.eos:
+                translation = translation[:-1]
+            output.append(translation.cpu())
+
+            # the cached target positions that the next step can attend to (the
+            # last generated token was not fed to the decoder)
+            num_target = int(decoder.get_ragged_state(state)['target_mask'].sum())
+            carry_len = min(self.carry, num_target)
+            if carry_len > 0:
+                decoder.slice_incremental_state_(state, -carry_len)
+                carry = state
+                offset += tokens.size(1) - 1
+            else:
+                carry, offset = None, 0
+
+        output.append(torch.LongTensor([self.eos]))
+        return torch.cat(output)
+
+    def prefill(self, left, chunk, right, src_lang_id, tgt_lang_id):
+        """Process the source of a chunk with its context tokens. Returns a
+        ragged incremental state where the context is masked for the target."""
+        decoder = self.model.decoder
+        device = next(self.model.parameters()).device
+        src_tokens = torch.cat((left, chunk, right, chunk.new_full((1,), self.eos))).unsqueeze(0).to(device)
+        src_lengths = src_tokens.new_full((1,), src_tokens.size(1))
+        encoder_out = self.model.encoder(src_tokens, src_lengths, src_lang_id=src_lang_id, tgt_lang_id=tgt_lang_id)
+
+        # the first step processes the source and a start token, which is
+        # dropped because it did not attend to the carried target positions
+        state = {}
+        start = src_tokens.new_full((1, 1), self.eos)
+        decoder(start, encoder_out, incremental_state=state)
+        decoder.make_incremental_state_ragged_(state, encoder_out, start)
+        decoder.slice_incremental_state_(state, 0, -1)
+
+        ragged_state = decoder.get_ragged_state(state)
+        context = torch.zeros_like(ragged_state['key_padding_mask'])
+        context[:, :left.numel()] = True
+        context[:, left.numel() + chunk.numel():-1] = True
+        decoder.set_ragged_state(state, ragged_state['key_padding_mask'] | context, ragged_state['target_mask'])
+        return state
+
+    def step(self, tokens, state, tgt_lang_id=None, offset=0):
+        # the source is already in the incremental state
+        encoder_out = {'encoder_out': None, 'encoder_padding_mask': None, 'tgt_lang_id': tgt_lang_id}
+        if offset > 0:
+            # the positions of a ragged state count the tokens of each row, only
+            # the last one is fed to the decoder
+            tokens = torch.cat((tokens.new_full((1, offset), self.eos), tokens), dim=1)
+        logits, _ = self.model.decoder(tokens, encoder_out, incremental_state=state)
+        logits = logits[:, -1, :]
+        logits[:, self.pad] = -float('inf')
+        return logits.argmax(dim=-1, keepdim=True)
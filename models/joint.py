@@ -76,10 +76,35 @@ class JointAttentionModel(FairseqEncoderDecoderModel):
                             help='embedding dimension for FFN')
         parser.add_argument('--decoder-attention-heads', type=int, metavar='N',
                             help='num attention heads')
+        parser.add_argument('--decoder-kv-heads', type=int, metavar='N',
+                            help='num key/value heads, each shared by a group of attention heads '
+                                 '(default: --decoder-attention-heads)')
+        parser.add_argument('--decoder-attention-heads-list', type=lambda x: options.eval_str_list(x, int),
+                            help='num attention heads of each layer, for pruned models '
+                                 '(default: --decoder-attention-heads in every layer)')
         parser.add_argument('--kernel-size-list', type=lambda x: options.eval_str_list(x, int),
                             help='list of kernel size (default: None)')
         parser.add_argument('--language-embeddings', action='store_true',
                             help='use language embeddings')
+        parser.add_argument('--num-languages', type=int, metavar='N',
+                            help='number of languages with their own language embeddings, selected '
+                                 'for each sentence by src_lang_id/tgt_lang_id (default: a single '
+                                 'language embedding for the source and one for the target)')
+        parser.add_argument('--fused-joint-layers', action='store_true',
+                            help='in training, run each layer once over the joint source-target '
+                                 'sequence with a block mask instead of once for the source and '
+                                 'once for the target')
+        parser.add_argument('--fused-joint-max-tokens', type=int, metavar='N',
+                            help='with --fused-joint-layers, run larger batches (sentences x (source + '
+                                 'target length)) in two passes. The threshold depends on the hardware '
+                                 'and has to be measured, e.g. 512 on one CPU core (default: no limit)')
+        parser.add_argument('--bf16-inference', action='store_true',
+                            help='run the decoder matmuls in bfloat16 during generation '
+                                 '(softmax and layernorm stay in fp32)')
+        parser.add_argument('--alignment-layer', type=int, metavar='N',
+                            help='layer whose attention from the target to the source, averaged '
+                                 'over heads, is returned for --print-alignment, negative values '
+                                 'count from the last layer (default: the penultimate layer)')
 
     @classmethod
     def build_model(cls, args, task):
@@ -88,6 +113,13 @@ class JointAttentionModel(FairseqEncoderDecoderModel):
         # make sure all arguments are present in older models
         base_architecture(args)
 
+        if args.alignment_layer is not None:
+            if not -args.decoder_layers <= args.alignment_layer < args.decoder_layers:
+                raise ValueError('--alignment-layer {} is out of range for {} decoder layers'.format(
+                    args.alignment_layer, args.decoder_layers))
+            # negative values count from the last layer
+            args.alignment_layer %= args.decoder_layers
+
         if not hasattr(args, 'max_source_positions'):
             args.max_source_positions = 1024
         if not hasattr(args, 'max_target_positions'):
@@ -134,6 +166,69 @@ class JointAttentionModel(FairseqEncoderDecoderModel):
         decoder = JointAttentionDecoder(args, tgt_dict, decoder_embed_tokens, left_pad=args.left_pad_target)
         return JointAttentionModel(encoder, decoder)
 
+    def make_generation_fast_(self, **kwargs):
+        super().make_generation_fast_(**kwargs)
+        self.fold_embedding_constants_()
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        prefix = name + '.' if name != '' else ''
+        if prefix + 'constants_folded' in state_dict and not hasattr(self, 'constants_folded'):
+            raise ValueError(
+                'the state dict was saved after make_generation_fast_() folded the embedding '
+                'constants into the weights, save the model before preparing it for generation'
+            )
+        super().upgrade_state_dict_named(state_dict, name)
+
+    def fold_embedding_constants_(self):
+        """Fold the embedding scale and the language embeddings into the
+        embedding tables for inference.
+
+        The scaled language embedding is added to the positional embeddings,
+        or to the token embeddings if there are none. The scaled token
+        embeddings are a copy, shared by the encoder and the decoder when
+        possible, so that the output projection keeps the original weights.
+        The attention scaling is folded by the attention modules.
+
+        The folding is recorded in the *constants_folded* buffer: it is only
+        applied once, and a state dict saved afterwards is not loaded into an
+        unfolded model.
+        """
+        if hasattr(self, 'constants_folded'):
+            return
+        self.register_buffer('constants_folded', torch.ones((), dtype=torch.bool))
+        scaled_embeddings = {}
+        for module in (self.encoder, self.decoder):
+            if module.embed_scale == 1.:
+                continue
+            lang_emb = None
+            if module.embed_language is not None and module.embed_language.dim() > 1:
+                # selected for each sentence, only the scale can be folded
+                module.embed_language.data.mul_(module.embed_scale)
+            elif module.embed_language is not None:
+                lang_emb = module.embed_scale * module.embed_language.detach()
+                if module.embed_positions is not None:
+                    add_to_positional_embedding_(module.embed_positions, lang_emb)
+                    lang_emb = None
+                elif getattr(module, 'project_in_dim', None) is not None:
+                    # the language embedding is added after the projection
+                    continue
+
+            key = (module.embed_tokens, module.embed_language if lang_emb is not None else None)
+            if key not in scaled_embeddings:
+                weight = module.embed_scale * module.embed_tokens.weight.detach()
+                if lang_emb is not None:
+                    weight = weight + lang_emb
+                scaled_embeddings[key] = nn.Embedding.from_pretrained(
+                    weight, freeze=True, padding_idx=module.embed_tokens.padding_idx)
+
+            if module is self.decoder and module.share_input_output_embed:
+                module.embed_out = module.embed_tokens.weight
+                module.share_input_output_embed = False
+            module.embed_tokens = scaled_embeddings[key]
+            module.embed_scale = 1.
+            if module.embed_language is not None and module.embed_language.dim() == 1:
+                module.embed_language = None
+
 
 class JointAttentionEncoder(FairseqEncoder):
     """
@@ -160,17 +255,22 @@ class JointAttentionEncoder(FairseqEncoder):
             args.max_source_positions, embed_dim, self.padding_idx,
             learned=args.encoder_learned_pos,
         ) if not args.no_token_positional_embeddings else None
-        self.embed_language = LanguageEmbedding(embed_dim) if args.language_embeddings else None
+        self.embed_language = LanguageEmbedding(
+            embed_dim, args.num_languages) if args.language_embeddings else None
 
         self.register_buffer('version', torch.Tensor([2]))
 
-    def forward(self, src_tokens, src_lengths):
+    def forward(self, src_tokens, src_lengths, src_lang_id=None, tgt_lang_id=None):
         """
         Args:
             src_tokens (LongTensor): tokens in the source language of shape
                 `(batch, src_len)`
             src_lengths (torch.LongTensor): lengths of each source sentence of
                 shape `(batch)`
+            src_lang_id (LongTensor, optional): language of each source
+                sentence of shape `(batch)`, required with *--num-languages*
+            tgt_lang_id (LongTensor, optional): language of each target
+                sentence of shape `(batch)`, passed to the decoder
 
         Returns:
             dict:
@@ -178,14 +278,20 @@ class JointAttentionEncoder(FairseqEncoder):
                   `(src_len, batch, embed_dim)`
                 - **encoder_padding_mask** (ByteTensor): the positions of
                   padding elements of shape `(batch, src_len)`
+                - **tgt_lang_id** (LongTensor): *tgt_lang_id*
         """
-        # embed tokens and positions
-        x = self.embed_scale * self.embed_tokens(src_tokens)
+        # embed tokens and positions (the scale is folded into the embeddings
+        # for inference)
+        x = self.embed_tokens(src_tokens)
+        if self.embed_scale != 1.:
+            x = self.embed_scale * x
         if self.embed_positions is not None:
             x += self.embed_positions(src_tokens)
         # language embedding
         if self.embed_language is not None:
-            lang_emb = self.embed_scale * self.embed_language.view(1, 1, -1)
+            lang_emb = select_language_embedding(self.embed_language, src_lang_id)
+            if self.embed_scale != 1.:
+                lang_emb = self.embed_scale * lang_emb
             x += lang_emb
         x = F.dropout(x, p=self.dropout, training=self.training)
 
@@ -200,6 +306,7 @@ class JointAttentionEncoder(FairseqEncoder):
         return {
             'encoder_out': x,  # T x B x C
             'encoder_padding_mask': encoder_padding_mask,  # B x T
+            'tgt_lang_id': tgt_lang_id,  # B
         }
 
     def reorder_encoder_out(self, encoder_out, new_order):
@@ -219,13 +326,15 @@ class JointAttentionEncoder(FairseqEncoder):
         if encoder_out['encoder_padding_mask'] is not None:
             encoder_out['encoder_padding_mask'] = \
                 encoder_out['encoder_padding_mask'].index_select(0, new_order)
+        if encoder_out.get('tgt_lang_id') is not None:
+            encoder_out['tgt_lang_id'] = encoder_out['tgt_lang_id'].index_select(0, new_order)
         return encoder_out
 
     def max_positions(self):
         """Maximum input length supported by the encoder."""
         if self.embed_positions is None:
             return self.max_source_positions
-        return min(self.max_source_positions, self.embed_positions.max_positions)
+        return min(self.max_source_positions, self.embed_positions.max_positions())
 
 
 class JointAttentionDecoder(FairseqIncrementalDecoder):
@@ -246,6 +355,12 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
         self.dropout = args.dropout
         self.share_input_output_embed = args.share_decoder_input_output_embed
         self.kernel_size_list = args.kernel_size_list
+        self.fused_joint_layers = getattr(args, 'fused_joint_layers', False)
+        self.fused_joint_max_tokens = getattr(args, 'fused_joint_max_tokens', None)
+        self.bf16_inference = getattr(args, 'bf16_inference', False)
+        self.alignment_layer = args.alignment_layer if args.alignment_layer is not None \
+            else max(args.decoder_layers - 2, 0)
+        self.need_attn = False
 
         input_embed_dim = embed_tokens.embedding_dim
         embed_dim = args.decoder_embed_dim
@@ -264,12 +379,13 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
             learned=args.decoder_learned_pos,
         ) if not args.no_token_positional_embeddings else None
 
-        self.embed_language = LanguageEmbedding(embed_dim) if args.language_embeddings else None
+        self.embed_language = LanguageEmbedding(
+            embed_dim, args.num_languages) if args.language_embeddings else None
 
         self.layers = nn.ModuleList([])
         self.layers.extend([
-            ProtectedTransformerDecoderLayer(args, no_encoder_attn=True)
-            for _ in range(args.decoder_layers)
+            self.build_decoder_layer(args, i)
+            for i in range(args.decoder_layers)
         ])
 
         self.project_out_dim = Linear(embed_dim, output_embed_dim, bias=False) \
@@ -278,19 +394,24 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
         if not self.share_input_output_embed:
             self.embed_out = nn.Parameter(torch.Tensor(len(dictionary), output_embed_dim))
             nn.init.normal_(self.embed_out, mean=0, std=output_embed_dim ** -0.5)
+        self.bf16_embed_out = None
         self.register_buffer('version', torch.Tensor([2]))
         self.normalize = args.decoder_normalize_before and final_norm
         if self.normalize:
             self.layer_norm = LayerNorm(embed_dim)
 
-    def forward(self, prev_output_tokens, encoder_out, incremental_state=None):
+    def build_decoder_layer(self, args, layer_idx=None):
+        return ProtectedTransformerDecoderLayer(args, no_encoder_attn=True, layer_idx=layer_idx)
+
+    def forward(self, prev_output_tokens, encoder_out, incremental_state=None, **unused):
         """
         Args:
             input (dict): with
                 prev_output_tokens (LongTensor): previous decoder outputs of shape
                     `(batch, tgt_len)`, for input feeding/teacher forcing
             encoder_out (Tensor, optional): output from the encoder, used for
-                encoder-side attention
+                encoder-side attention. Its *tgt_lang_id* selects the target
+                language embeddings with *--num-languages*
             incremental_state (dict): dictionary used for storing state during
                 :ref:`Incremental decoding`
 
@@ -298,24 +419,35 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
             tuple:
                 - the last decoder layer's output of shape `(batch, tgt_len,
                   vocab)`
-                - the last decoder layer's attention weights of shape `(batch,
-                  tgt_len, src_len)`
+                - a dictionary with the attention weights of the target to the
+                  source in *args.alignment_layer*, averaged over heads, of
+                  shape `(batch, tgt_len, src_len)` (only after
+                  ``make_generation_fast_(need_attn=True)`` and not with a
+                  ragged incremental state) and the inner states
         """
         tgt_len = prev_output_tokens.size(1)
+        ragged_state = self.get_ragged_state(incremental_state)
+        # the first incremental step processes the source and the whole target
+        # prefix in parallel (a left-padded prefix makes the state ragged)
+        prefill = incremental_state is not None and len(incremental_state) == 0
 
-        # embed positions
+        # embed positions (rows of a ragged state are left-padded and have
+        # their own positions)
         positions = self.embed_positions(
             prev_output_tokens,
-            incremental_state=incremental_state,
+            incremental_state=incremental_state if ragged_state is None and not prefill else None,
         ) if self.embed_positions is not None else None
 
-        if incremental_state is not None:
+        if incremental_state is not None and not prefill:
             prev_output_tokens = prev_output_tokens[:, -1:]
             if positions is not None:
                 positions = positions[:, -1:]
 
-        # embed tokens and positions
-        x = self.embed_scale * self.embed_tokens(prev_output_tokens)
+        # embed tokens and positions (the scale is folded into the embeddings
+        # for inference)
+        x = self.embed_tokens(prev_output_tokens)
+        if self.embed_scale != 1.:
+            x = self.embed_scale * x
 
         if self.project_in_dim is not None:
             x = self.project_in_dim(x)
@@ -325,7 +457,9 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
 
         # language embedding
         if self.embed_language is not None:
-            lang_emb = self.embed_scale * self.embed_language.view(1, 1, -1)
+            lang_emb = select_language_embedding(self.embed_language, encoder_out.get('tgt_lang_id'))
+            if self.embed_scale != 1.:
+                lang_emb = self.embed_scale * lang_emb
             x += lang_emb
 
         x = F.dropout(x, p=self.dropout, training=self.training)
@@ -335,59 +469,125 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
         attn = None
         inner_states = [x]
         source = encoder_out['encoder_out']
-        process_source = incremental_state is None or len(incremental_state) == 0
+        process_source = incremental_state is None or prefill
+        # only the source slice of the attention of one layer is computed
+        alignment_layer = self.alignment_layer if self.need_attn and ragged_state is None else None
 
-        # extended padding mask
+        # extended padding mask (target prefixes of different lengths are left-padded)
         source_padding_mask = encoder_out['encoder_padding_mask']
-        if source_padding_mask is not None:
-            target_padding_mask = source_padding_mask.new_zeros((source_padding_mask.size(0), tgt_len))
-            self_attn_padding_mask = torch.cat((source_padding_mask, target_padding_mask), dim=1)
+        target_padding_mask = None
+        if prefill and tgt_len > 1:
+            target_padding_mask = prev_output_tokens.eq(self.embed_tokens.padding_idx)
+            if not target_padding_mask.any():
+                target_padding_mask = None
+            else:
+                # the following steps need the positions and the padding of
+                # each row, which the ragged state keeps track of
+                self.make_incremental_state_ragged_(incremental_state, encoder_out, prev_output_tokens)
+        if source_padding_mask is not None or target_padding_mask is not None:
+            if source_padding_mask is None:
+                source_padding_mask = target_padding_mask.new_zeros((target_padding_mask.size(0), source.size(0)))
+            if target_padding_mask is None:
+                target_padding_mask = source_padding_mask.new_zeros((source_padding_mask.size(0), tgt_len))
+            self_attn_padding_mask = torch.cat((source_padding_mask, target_padding_mask.type_as(source_padding_mask)), dim=1)
         else:
             self_attn_padding_mask = None
 
-        # transformer layers
-        for i, layer in enumerate(self.layers):
-
-            if self.kernel_size_list is not None:
-                target_mask = self.local_mask(x, self.kernel_size_list[i], causal=True, tgt_len=tgt_len)
-            elif incremental_state is None:
-                target_mask = self.buffered_future_mask(x)
-            else:
-                target_mask = None
-
-            if target_mask is not None:
-                zero_mask = target_mask.new_zeros((target_mask.size(0), source.size(0)))
-                self_attn_mask = torch.cat((zero_mask, target_mask), dim=1)
-            else:
-                self_attn_mask = None
+        # full sequence: run each layer once over the joint [source; target] sequence
+        if incremental_state is None and self.use_fused_joint_layers(source, x):
+            src_len = source.size(0)
+            joint_masks = {}
+            x = torch.cat((source, x), dim=0)
+            for i, layer in enumerate(self.layers):
+                kernel_size = self.kernel_size_list[i] if self.kernel_size_list is not None else None
+                if kernel_size not in joint_masks:
+                    joint_masks[kernel_size] = self.joint_mask(x, src_len, kernel_size)
+                x, layer_attn = layer(
+                    x,
+                    None,
+                    None,
+                    None,
+                    self_attn_mask=joint_masks[kernel_size],
+                    self_attn_padding_mask=self_attn_padding_mask,
+                    source_attn_len=src_len if i == alignment_layer else None,
+                )
+                if layer_attn is not None:
+                    attn = layer_attn[:, src_len:]
+                inner_states.append(x[:src_len])
+                inner_states.append(x[src_len:])
+            x = x[src_len:]
+        elif ragged_state is not None:
+            # rows with different source and target lengths share the cached
+            # keys and values, which are left-padded to a common length
+            key_padding_mask = ragged_state['key_padding_mask']
+            target_mask = ragged_state['target_mask']
+            key_padding_mask = torch.cat((key_padding_mask, key_padding_mask.new_zeros((x.size(1), 1))), dim=1)
+            target_mask = torch.cat((target_mask, target_mask.new_ones((x.size(1), 1))), dim=1)
+            self.set_ragged_state(incremental_state, key_padding_mask, target_mask)
+            key_len = key_padding_mask.size(1)
+            for i, layer in enumerate(self.layers):
+                if self.kernel_size_list is not None:
+                    # mask the target positions outside of the causal local window
+                    outside = torch.arange(key_len, device=x.device).lt(key_len - self.kernel_size_list[i])
+                    self_attn_padding_mask = key_padding_mask | (target_mask & outside.unsqueeze(0))
+                else:
+                    self_attn_padding_mask = key_padding_mask
+                x, _ = layer(
+                    x,
+                    None,
+                    None,
+                    incremental_state,
+                    self_attn_padding_mask=self_attn_padding_mask
+                )
+                inner_states.append(x)
+        else:
+            # the source keys and values are kept in the incremental state (a
+            # temporary one in training) and the target attends to them
+            for i, layer in enumerate(self.layers):
 
-            state = incremental_state
-            if process_source:
-                if state is None:
-                    state = {}
                 if self.kernel_size_list is not None:
-                    source_mask = self.local_mask(source, self.kernel_size_list[i], causal=False)
+                    target_mask = self.local_mask(x, self.kernel_size_list[i], causal=True, tgt_len=tgt_len)
+                elif x.size(0) > 1:
+                    target_mask = self.buffered_future_mask(x)
                 else:
-                    source_mask = None
-                source, attn = layer(
-                    source,
+                    target_mask = None
+
+                if target_mask is not None:
+                    zero_mask = target_mask.new_zeros((target_mask.size(0), source.size(0)))
+                    self_attn_mask = torch.cat((zero_mask, target_mask), dim=1)
+                else:
+                    self_attn_mask = None
+
+                state = incremental_state
+                if process_source:
+                    if state is None:
+                        state = {}
+                    if self.kernel_size_list is not None:
+                        source_mask = self.local_mask(source, self.kernel_size_list[i], causal=False)
+                    else:
+                        source_mask = None
+                    source, _ = layer(
+                        source,
+                        None,
+                        None,
+                        state,
+                        self_attn_mask=source_mask,
+                        self_attn_padding_mask=source_padding_mask
+                    )
+                    inner_states.append(source)
+
+                x, layer_attn = layer(
+                    x,
                     None,
                     None,
                     state,
-                    self_attn_mask=source_mask,
-                    self_attn_padding_mask=source_padding_mask
+                    self_attn_mask=self_attn_mask,
+                    self_attn_padding_mask=self_attn_padding_mask,
+                    source_attn_len=source.size(0) if i == alignment_layer else None,
                 )
-                inner_states.append(source)
-
-            x, attn = layer(
-                x,
-                None,
-                None,
-                state,
-                self_attn_mask=self_attn_mask,
-                self_attn_padding_mask=self_attn_padding_mask
-            )
-            inner_states.append(x)
+                if layer_attn is not None:
+                    attn = layer_attn
+                inner_states.append(x)
 
         if self.normalize:
             x = self.layer_norm(x)
@@ -399,7 +599,9 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
             x = self.project_out_dim(x)
 
         # project back to size of vocabulary
-        if self.share_input_output_embed:
+        if self.bf16_embed_out is not None:
+            x = F.linear(x.type_as(self.bf16_embed_out), self.bf16_embed_out).float()
+        elif self.share_input_output_embed:
             x = F.linear(x, self.embed_tokens.weight)
         else:
             x = F.linear(x, self.embed_out)
@@ -413,7 +615,119 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
             return self.max_target_positions
-        return min(self.max_target_positions, self.embed_positions.max_positions)
+        return min(self.max_target_positions, self.embed_positions.max_positions())
+
+    def get_ragged_state(self, incremental_state):
+        return utils.get_incremental_state(self, incremental_state, 'ragged_state')
+
+    def set_ragged_state(self, incremental_state, key_padding_mask, target_mask):
+        utils.set_incremental_state(self, incremental_state, 'ragged_state', {
+            'key_padding_mask': key_padding_mask,
+            'target_mask': target_mask,
+        })
+
+    def make_incremental_state_ragged_(self, incremental_state, encoder_out, prev_output_tokens):
+        """Track the padding of each row of *incremental_state* explicitly.
+
+        Must be called after the first decoding step, with the (left-padded)
+        *prev_output_tokens* given to that step. A first step with a
+        left-padded target prefix calls it itself. Afterwards, rows can be
+        removed with :func:`reorder_incremental_state` and
+        :func:`trim_incremental_state_`, and rows of other states can be
+        appended with :func:`concat_incremental_state_`. The following steps
+        expect *prev_output_tokens* to be left-padded.
+        """
+        source_padding_mask = encoder_out['encoder_padding_mask']
+        bsz, src_len = encoder_out['encoder_out'].size(1), encoder_out['encoder_out'].size(0)
+        if source_padding_mask is None:
+            source_padding_mask = encoder_out['encoder_out'].new_zeros((bsz, src_len), dtype=torch.bool)
+        source_padding_mask = source_padding_mask.bool()
+        target_padding_mask = prev_output_tokens.eq(self.embed_tokens.padding_idx)
+        self.set_ragged_state(
+            incremental_state,
+            torch.cat((source_padding_mask, target_padding_mask), dim=1),
+            torch.cat((source_padding_mask.new_zeros((bsz, src_len)), ~target_padding_mask), dim=1),
+        )
+
+    def concat_incremental_state_(self, incremental_state, other_state):
+        """Append the rows of the ragged *other_state* to the ragged *incremental_state*."""
+        state, other = self.get_ragged_state(incremental_state), self.get_ragged_state(other_state)
+        length = max(state['key_padding_mask'].size(1), other['key_padding_mask'].size(1))
+        for module in self.modules():
+            if isinstance(module, ProtectedMultiheadAttention):
+                module.concat_incremental_state(incremental_state, other_state, length)
+
+        def concat(key, value):
+            masks = (state[key], other[key])
+            return torch.cat([F.pad(mask, (length - mask.size(1), 0), value=value) for mask in masks], dim=0)
+
+        self.set_ragged_state(incremental_state, concat('key_padding_mask', True), concat('target_mask', False))
+
+    def trim_incremental_state_(self, incremental_state):
+        """Drop the cached positions that are padding in every row of a ragged state."""
+        state = self.get_ragged_state(incremental_state)
+        start = int(state['key_padding_mask'].all(dim=0).long().cumprod(dim=0).sum())
+        if start > 0:
+            for module in self.modules():
+                if isinstance(module, ProtectedMultiheadAttention):
+                    module.trim_incremental_state(incremental_state, start)
+            self.set_ragged_state(
+                incremental_state, state['key_padding_mask'][:, start:], state['target_mask'][:, start:])
+
+    def slice_incremental_state_(self, incremental_state, start, end=None):
+        """Keep the cached positions from *start* to *end* of a ragged state."""
+        state = self.get_ragged_state(incremental_state)
+        for module in self.modules():
+            if isinstance(module, ProtectedMultiheadAttention):
+                module.trim_incremental_state(incremental_state, start, end)
+        self.set_ragged_state(
+            incremental_state, state['key_padding_mask'][:, start:end], state['target_mask'][:, start:end])
+
+    def extend_incremental_state_(self, incremental_state, other_state):
+        """Append the cached positions of the ragged *other_state* after those
+        of the ragged *incremental_state*. Both states must have the same rows.
+
+        With *--kernel-size-list*, the next decoding step only attends to the
+        last ``kernel_size - 1`` cached target positions of each layer, so the
+        target positions of a previous state can be carried over to a new
+        source this way (see :mod:`document_translation`).
+        """
+        state, other = self.get_ragged_state(incremental_state), self.get_ragged_state(other_state)
+        for module in self.modules():
+            if isinstance(module, ProtectedMultiheadAttention):
+                module.extend_incremental_state(incremental_state, other_state)
+        self.set_ragged_state(
+            incremental_state,
+            torch.cat((state['key_padding_mask'], other['key_padding_mask']), dim=1),
+            torch.cat((state['target_mask'], other['target_mask']), dim=1),
+        )
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        super().reorder_incremental_state(incremental_state, new_order)
+        state = self.get_ragged_state(incremental_state)
+        if state is not None:
+            self.set_ragged_state(
+                incremental_state,
+                state['key_padding_mask'].index_select(0, new_order),
+                state['target_mask'].index_select(0, new_order),
+            )
+
+    def make_generation_fast_(self, need_attn=False, **kwargs):
+        self.need_attn = need_attn
+        if self.bf16_inference:
+            self.prepare_for_bf16_inference_()
+
+    def prepare_for_bf16_inference_(self):
+        """Run the layer and output projections in bfloat16.
+
+        The embeddings, the layer norms and the attention softmax are kept in
+        fp32. The shared embedding matrix is copied for the output projection
+        so that the input embeddings are not rounded.
+        """
+        for layer in self.layers:
+            layer.prepare_for_bf16_inference_()
+        embed_out = self.embed_tokens.weight if self.share_input_output_embed else self.embed_out
+        self.bf16_embed_out = embed_out.detach().to(torch.bfloat16)
 
     def buffered_future_mask(self, tensor):
         """Cached future mask."""
@@ -425,6 +739,39 @@ class JointAttentionDecoder(FairseqIncrementalDecoder):
             self._future_mask = torch.triu(utils.fill_with_neg_inf(self._future_mask.resize_(dim, dim)), 1)
         return self._future_mask[:dim, :dim]
 
+    def use_fused_joint_layers(self, source, target):
+        """Whether to run the layers once over the joint sequence.
+
+        The joint sequence halves the number of calls per layer, but also
+        computes the masked source-to-target block of the attention, so it is
+        only faster for batches that are small for the hardware, where the
+        calls dominate (see *--fused-joint-max-tokens*).
+        """
+        if not self.fused_joint_layers:
+            return False
+        return self.fused_joint_max_tokens is None or \
+            target.size(1) * (source.size(0) + target.size(0)) <= self.fused_joint_max_tokens
+
+    def joint_mask(self, tensor, src_len, kernel_size=None):
+        """Block mask of the joint [source; target] sequence.
+
+        Source positions attend to the source only (with the non-causal
+        locality constraint), target positions attend to the whole source and
+        causally to the target (with the causal locality constraint).
+        """
+        tgt_len = tensor.size(0) - src_len
+        source, target = tensor[:src_len], tensor[src_len:]
+        if kernel_size is not None:
+            source_mask = self.local_mask(source, kernel_size, causal=False)
+            target_mask = self.local_mask(target, kernel_size, causal=True, tgt_len=tgt_len)
+        else:
+            source_mask = tensor.new_zeros((src_len, src_len))
+            target_mask = self.buffered_future_mask(target)
+        return torch.cat((
+            torch.cat((source_mask, utils.fill_with_neg_inf(tensor.new(src_len, tgt_len))), dim=1),
+            torch.cat((tensor.new_zeros((tgt_len, src_len)), target_mask), dim=1),
+        ), dim=0)
+
     def local_mask(self, tensor, kernel_size, causal, tgt_len=None):
         """Locality constraint mask."""
         rows = tensor.size(0)
@@ -461,14 +808,26 @@ class ProtectedTransformerDecoderLayer(nn.Module):
         args (argparse.Namespace): parsed command-line arguments
         no_encoder_attn (bool, optional): whether to attend to encoder outputs
             (default: False).
+        layer_idx (int, optional): index of the layer, selects its number of
+            heads in *args.decoder_attention_heads_list* (default: None).
     """
 
-    def __init__(self, args, no_encoder_attn=False):
+    def __init__(self, args, no_encoder_attn=False, layer_idx=None):
         super().__init__()
         self.embed_dim = args.decoder_embed_dim
+        num_heads = args.decoder_attention_heads
+        num_kv_heads = args.decoder_kv_heads or num_heads
+        heads_list = args.decoder_attention_heads_list
+        if heads_list is not None and layer_idx is not None:
+            # pruned heads: the head size and the number of query heads
+            # sharing a key/value head are those of the unpruned model
+            group_size = num_heads // num_kv_heads
+            num_heads, num_kv_heads = heads_list[layer_idx], heads_list[layer_idx] // group_size
         self.self_attn = ProtectedMultiheadAttention(
-            self.embed_dim, args.decoder_attention_heads,
+            self.embed_dim, num_heads,
             dropout=args.attention_dropout,
+            num_kv_heads=num_kv_heads,
+            head_dim=self.embed_dim // args.decoder_attention_heads,
         )
         self.dropout = args.dropout
         self.relu_dropout = args.relu_dropout
@@ -491,24 +850,44 @@ class ProtectedTransformerDecoderLayer(nn.Module):
 
         self.final_layer_norm = LayerNorm(self.embed_dim)
         self.need_attn = True
+        # set by make_generation_fast_, see forward_inference
+        self.fast_inference = False
+        self._ffn_buffer = None
 
         self.onnx_trace = False
 
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
 
+    def prepare_for_bf16_inference_(self):
+        self.self_attn.prepare_for_bf16_inference_()
+        if self.encoder_attn is not None:
+            self.encoder_attn.prepare_for_bf16_inference_()
+        self.fc1.to(torch.bfloat16)
+        self.fc2.to(torch.bfloat16)
+
     def forward(self, x, encoder_out, encoder_padding_mask, incremental_state,
                 prev_self_attn_state=None, prev_attn_state=None, self_attn_mask=None,
-                self_attn_padding_mask=None):
+                self_attn_padding_mask=None, source_attn_len=None):
         """
         Args:
             x (Tensor): input to the layer of shape `(seq_len, batch, embed_dim)`
             encoder_padding_mask (ByteTensor): binary ByteTensor of shape
                 `(batch, src_len)` where padding elements are indicated by ``1``.
+            source_attn_len (int, optional): return the self attention
+                weights to the first *source_attn_len* positions (the source),
+                averaged over heads
 
         Returns:
             encoded output of shape `(batch, src_len, embed_dim)`
         """
+        if self.fast_inference and not self.training and not torch.is_grad_enabled():
+            return self.forward_inference(
+                x, encoder_out, encoder_padding_mask, incremental_state,
+                prev_self_attn_state=prev_self_attn_state, prev_attn_state=prev_attn_state,
+                self_attn_mask=self_attn_mask, self_attn_padding_mask=self_attn_padding_mask,
+                source_attn_len=source_attn_len,
+            )
         residual = x
         x = self.maybe_layer_norm(self.self_attn_layer_norm, x, before=True)
         if prev_self_attn_state is not None:
@@ -517,20 +896,20 @@ class ProtectedTransformerDecoderLayer(nn.Module):
             prev_key, prev_value = prev_self_attn_state
             saved_state = {"prev_key": prev_key, "prev_value": prev_value}
             self.self_attn._set_input_buffer(incremental_state, saved_state)
-        x, _ = self.self_attn(
+        x, attn = self.self_attn(
             query=x,
             key=x,
             value=x,
             key_padding_mask=self_attn_padding_mask,
             incremental_state=incremental_state,
-            need_weights=False,
+            need_weights=source_attn_len is not None,
             attn_mask=self_attn_mask,
+            weights_len=source_attn_len,
         )
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
         x = self.maybe_layer_norm(self.self_attn_layer_norm, x, after=True)
 
-        attn = None
         if self.encoder_attn is not None:
             residual = x
             x = self.maybe_layer_norm(self.encoder_attn_layer_norm, x, before=True)
@@ -555,7 +934,7 @@ class ProtectedTransformerDecoderLayer(nn.Module):
 
         residual = x
         x = self.maybe_layer_norm(self.final_layer_norm, x, before=True)
-        x = F.relu(self.fc1(x))
+        x = F.relu(self.fc1(x.type_as(self.fc1.weight)))
         x = F.dropout(x, p=self.relu_dropout, training=self.training)
         x = self.fc2(x)
         x = F.dropout(x, p=self.dropout, training=self.training)
@@ -576,6 +955,94 @@ class ProtectedTransformerDecoderLayer(nn.Module):
 
     def make_generation_fast_(self, need_attn=False, **kwargs):
         self.need_attn = need_attn
+        self.fast_inference = not self.onnx_trace
+
+    def ffn_buffer(self, size, like):
+        """Return a view of the reusable FFN buffer with the given size."""
+        numel = 1
+        for dim in size:
+            numel *= dim
+        buffer = self._ffn_buffer
+        if buffer is None or buffer.numel() < numel or buffer.dtype != like.dtype or buffer.device != like.device:
+            buffer = self._ffn_buffer = like.new_empty(numel)
+        return buffer[:numel].view(size)
+
+    @staticmethod
+    def add_residual(x, residual):
+        # x is a new tensor owned by this layer, so it can be overwritten
+        if x.dtype == residual.dtype:
+            return x.add_(residual)
+        return residual + x
+
+    def forward_inference(self, x, encoder_out, encoder_padding_mask, incremental_state,
+                          prev_self_attn_state=None, prev_attn_state=None, self_attn_mask=None,
+                          self_attn_padding_mask=None, source_attn_len=None):
+        """Inference-only version of :func:`forward`.
+
+        Used after :func:`make_generation_fast_` in eval mode when autograd is
+        disabled (as in generation), so the outputs are regular tensors and
+        the layer can still be trained. Dropout is skipped, the residual
+        connections are added in place into the freshly computed sublayer
+        outputs before the layer norm (which still allocates its output, there
+        is no fused residual + layer norm kernel), and the FFN hidden
+        activations are written into a buffer that is reused across layer
+        calls and decoding steps.
+        """
+        residual = x
+        x = self.maybe_layer_norm(self.self_attn_layer_norm, x, before=True)
+        if prev_self_attn_state is not None:
+            if incremental_state is None:
+                incremental_state = {}
+            prev_key, prev_value = prev_self_attn_state
+            saved_state = {"prev_key": prev_key, "prev_value": prev_value}
+            self.self_attn._set_input_buffer(incremental_state, saved_state)
+        x, attn = self.self_attn(
+            query=x,
+            key=x,
+            value=x,
+            key_padding_mask=self_attn_padding_mask,
+            incremental_state=incremental_state,
+            need_weights=source_attn_len is not None,
+            attn_mask=self_attn_mask,
+            weights_len=source_attn_len,
+        )
+        x = self.add_residual(x, residual)
+        x = self.maybe_layer_norm(self.self_attn_layer_norm, x, after=True)
+
+        if self.encoder_attn is not None:
+            residual = x
+            x = self.maybe_layer_norm(self.encoder_attn_layer_norm, x, before=True)
+            if prev_attn_state is not None:
+                if incremental_state is None:
+                    incremental_state = {}
+                prev_key, prev_value = prev_attn_state
+                saved_state = {"prev_key": prev_key, "prev_value": prev_value}
+                self.encoder_attn._set_input_buffer(incremental_state, saved_state)
+            x, attn = self.encoder_attn(
+                query=x,
+                key=encoder_out,
+                value=encoder_out,
+                key_padding_mask=encoder_padding_mask,
+                incremental_state=incremental_state,
+                static_kv=True,
+                need_weights=self.need_attn,
+            )
+            x = self.add_residual(x, residual)
+            x = self.maybe_layer_norm(self.encoder_attn_layer_norm, x, after=True)
+
+        residual = x
+        x = self.maybe_layer_norm(self.final_layer_norm, x, before=True)
+        x = x.type_as(self.fc1.weight)
+        hidden = self.ffn_buffer(x.size()[:-1] + (self.fc1.out_features,), x)
+        torch.addmm(
+            self.fc1.bias, x.reshape(-1, self.embed_dim), self.fc1.weight.t(),
+            out=hidden.view(-1, self.fc1.out_features),
+        )
+        hidden.relu_()
+        x = self.fc2(hidden)
+        x = self.add_residual(x, residual)
+        x = self.maybe_layer_norm(self.final_layer_norm, x, after=True)
+        return x, attn
 
 
 def Embedding(num_embeddings, embedding_dim, padding_idx):
@@ -585,12 +1052,32 @@ def Embedding(num_embeddings, embedding_dim, padding_idx):
     return m
 
 
-def LanguageEmbedding(embedding_dim):
-    m = nn.Parameter(torch.Tensor(embedding_dim))
+def LanguageEmbedding(embedding_dim, num_languages=None):
+    if num_languages is None:
+        m = nn.Parameter(torch.Tensor(embedding_dim))
+    else:
+        m = nn.Parameter(torch.Tensor(num_languages, embedding_dim))
     nn.init.normal_(m, mean=0, std=embedding_dim ** -0.5)
     return m
 
 
+def select_language_embedding(embed_language, lang_id):
+    """Language embedding added to the `(batch, seq_len, embed_dim)` input:
+    the single vector, or the row of each sentence in a table of languages."""
+    if embed_language.dim() == 1:
+        return embed_language.view(1, 1, -1)
+    assert lang_id is not None, 'models with --num-languages require the language id of every sentence'
+    return embed_language.index_select(0, lang_id).unsqueeze(1)
+
+
+def add_to_positional_embedding_(embed_positions, bias):
+    """Add *bias* to every row of a learned or sinusoidal positional embedding."""
+    if isinstance(embed_positions, nn.Embedding):
+        embed_positions.weight.data.add_(bias)
+    else:
+        embed_positions.weights = embed_positions.weights + bias.to(embed_positions.weights)
+
+
 def LayerNorm(embedding_dim):
     m = nn.LayerNorm(embedding_dim)
     return m
@@ -618,6 +1105,8 @@ def base_architecture(args):
 
     args.decoder_ffn_embed_dim = getattr(args, 'decoder_ffn_embed_dim', 2048)
     args.decoder_attention_heads = getattr(args, 'decoder_attention_heads', 8)
+    args.decoder_kv_heads = getattr(args, 'decoder_kv_heads', None)
+    args.decoder_attention_heads_list = getattr(args, 'decoder_attention_heads_list', None)
     args.decoder_layers = getattr(args, 'decoder_layers', 14)
 
     args.decoder_normalize_before = getattr(args, 'decoder_normalize_before', False)
@@ -629,7 +1118,14 @@ def base_architecture(args):
     args.no_token_positional_embeddings = getattr(args, 'no_token_positional_embeddings', False)
     args.kernel_size_list = getattr(args, 'kernel_size_list', None)
     assert args.kernel_size_list is None or len(args.kernel_size_list) == args.decoder_layers, "kernel_size_list doesn't match decoder_layers"
+    assert args.decoder_attention_heads_list is None or len(args.decoder_attention_heads_list) == args.decoder_layers, \
+        "decoder_attention_heads_list doesn't match decoder_layers"
     args.language_embeddings = getattr(args, 'language_embeddings', True)
+    args.num_languages = getattr(args, 'num_languages', None)
+    args.fused_joint_layers = getattr(args, 'fused_joint_layers', False)
+    args.fused_joint_max_tokens = getattr(args, 'fused_joint_max_tokens', None)
+    args.bf16_inference = getattr(args, 'bf16_inference', False)
+    args.alignment_layer = getattr(args, 'alignment_layer', None)
 
 
 @register_model_architecture('joint_attention', 'joint_attention_iwslt_de_en')
@@ -0,0 +1,328 @@
+"""Translation task for the joint source-target models.
+
+The joint models run self attention over the concatenation of source and
+target, so the cost of a batch grows with the square of the combined length
+rather than with the number of tokens. This task sorts the data by combined
+length and builds batches bounded by their padded attention cost.
+
+With *--lang-pairs*, the language pairs are trained and evaluated together in
+mixed batches that carry the language of every sentence.
+"""
+import bisect
+
+import numpy as np
+import torch
+
+from fairseq.data import FairseqDataset, data_utils, iterators
+from fairseq.tasks import register_task
+from fairseq.tasks.translation import TranslationTask, load_langpair_dataset
+
+
+def attention_cost(src_len, tgt_len):
+    """Query-key pairs computed by one joint attention layer for a sentence.
+
+    The source attends to the source (`src_len x src_len`) and the target
+    attends to the source and to itself (`tgt_len x (src_len + tgt_len)`).
+    Local attention is implemented with additive masks over the full score
+    matrices, so the locality constraints do not reduce this cost.
+    """
+    return src_len * src_len + tgt_len * (src_len + tgt_len)
+
+
+def filter_by_attention_cost(indices, src_sizes, tgt_sizes, max_attention_cost, raise_exception=False):
+    """
+    Filter indices of sentences whose attention cost alone exceeds
+    *max_attention_cost*.
+
+    Args:
+        indices (np.ndarray): ordered array of dataset indices
+        src_sizes (np.ndarray): source lengths
+        tgt_sizes (np.ndarray): target lengths, or ``None``
+        max_attention_cost (int): max number of query-key pairs per layer
+        raise_exception (bool, optional): if ``True``, raise an exception if
+            any elements are filtered (default: False).
+    """
+    src_lens = src_sizes[indices].astype(np.int64)
+    tgt_lens = tgt_sizes[indices].astype(np.int64) if tgt_sizes is not None else np.zeros_like(src_lens)
+    valid = attention_cost(src_lens, tgt_lens) <= max_attention_cost
+    ignored = indices[~valid].tolist()
+    if len(ignored) > 0 and raise_exception:
+        raise Exception((
+            'Size of sample #{} is invalid (={}) since its attention cost {} exceeds '
+            '--max-attention-cost {}, skip this example with --skip-invalid-size-inputs-valid-test'
+        ).format(ignored[0], (int(src_lens[~valid][0]), int(tgt_lens[~valid][0])),
+                 int(attention_cost(src_lens[~valid][0], tgt_lens[~valid][0])), max_attention_cost))
+    if len(ignored) > 0:
+        print((
+            '| WARNING: {} samples exceed --max-attention-cost {} and will be skipped, '
+            'first few sample ids={}'
+        ).format(len(ignored), max_attention_cost, ignored[:10]))
+    return indices[valid]
+
+
+def batch_by_attention_cost(
+    indices, src_sizes, tgt_sizes, max_attention_cost, max_tokens=None,
+    max_sentences=None, required_batch_size_multiple=1,
+):
+    """
+    Yield mini-batches of indices whose padded joint attention cost is
+    bounded by *max_attention_cost*.
+
+    Args:
+        indices (List[int]): ordered list of dataset indices, without the
+            sentences filtered by :func:`filter_by_attention_cost`
+        src_sizes (np.ndarray): source lengths
+        tgt_sizes (np.ndarray): target lengths, or ``None``
+        max_attention_cost (int): max number of query-key pairs per layer in
+            each batch, padding included
+        max_tokens (int, optional): max number of tokens in each batch
+            (default: None).
+        max_sentences (int, optional): max number of sentences in each
+            batch (default: None).
+        required_batch_size_multiple (int, optional): require batch size to
+            be a multiple of N (default: 1).
+    """
+    bsz_mult = required_batch_size_multiple
+    batches = []
+    batch = []
+    max_src = max_tgt = 0
+
+    def is_batch_full(num_sentences, src_len, tgt_len):
+        if num_sentences == 0:
+            return False
+        if max_sentences is not None and num_sentences > max_sentences:
+            return True
+        if max_tokens is not None and num_sentences * max(src_len, tgt_len) > max_tokens:
+            return True
+        return num_sentences * attention_cost(src_len, tgt_len) > max_attention_cost
+
+    for idx in indices:
+        src_len = int(src_sizes[idx])
+        tgt_len = int(tgt_sizes[idx]) if tgt_sizes is not None else 0
+        assert attention_cost(src_len, tgt_len) <= max_attention_cost, (
+            'sentence at index {} of size ({}, {}) has an attention cost of {} which '
+            'exceeds --max-attention-cost {}'.format(
+                idx, src_len, tgt_len, attention_cost(src_len, tgt_len), max_attention_cost)
+        )
+
+        new_src, new_tgt = max(max_src, src_len), max(max_tgt, tgt_len)
+        if is_batch_full(len(batch) + 1, new_src, new_tgt):
+            mod_len = max(
+                bsz_mult * (len(batch) // bsz_mult),
+                len(batch) % bsz_mult,
+            )
+            batches.append(batch[:mod_len])
+            batch = batch[mod_len:]
+            max_src = max((int(src_sizes[i]) for i in batch), default=0)
+            max_tgt = max((int(tgt_sizes[i]) for i in batch), default=0) if tgt_sizes is not None else 0
+            new_src, new_tgt = max(max_src, src_len), max(max_tgt, tgt_len)
+
+        batch.append(idx)
+        max_src, max_tgt = new_src, new_tgt
+
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+class LanguagePairsDataset(FairseqDataset):
+    """
+    Concatenation of language pair datasets that share a dictionary. Batches
+    mix the language pairs and their *net_input* has the source and target
+    language of every sentence (*src_lang_id* and *tgt_lang_id*).
+
+    Args:
+        datasets (List[~fairseq.data.LanguagePairDataset]): the datasets
+        lang_ids (List[Tuple[int, int]]): source and target language id of
+            each dataset
+    """
+
+    def __init__(self, datasets, lang_ids):
+        super().__init__()
+        self.datasets = datasets
+        self.cumulative_sizes = np.cumsum([len(dataset) for dataset in datasets])
+        self.src_sizes = np.concatenate([dataset.src_sizes for dataset in datasets])
+        self.tgt_sizes = np.concatenate([dataset.tgt_sizes for dataset in datasets]) \
+            if all(dataset.tgt_sizes is not None for dataset in datasets) else None
+        self.src_lang_ids = np.concatenate([
+            np.full(len(dataset), src_lang_id, dtype=np.int64)
+            for dataset, (src_lang_id, _) in zip(datasets, lang_ids)
+        ])
+        self.tgt_lang_ids = np.concatenate([
+            np.full(len(dataset), tgt_lang_id, dtype=np.int64)
+            for dataset, (_, tgt_lang_id) in zip(datasets, lang_ids)
+        ])
+        self.shuffle = datasets[0].shuffle
+
+    def __getitem__(self, index):
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, index)
+        sample_idx = index - (self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0)
+        sample = self.datasets[dataset_idx][sample_idx]
+        sample['id'] = index
+        return sample
+
+    def __len__(self):
+        return int(self.cumulative_sizes[-1])
+
+    def collater(self, samples):
+        batch = self.datasets[0].collater(samples)
+        if len(batch) > 0:
+            # the samples are sorted by the collater
+            ids = batch['id'].numpy()
+            batch['net_input']['src_lang_id'] = torch.from_numpy(self.src_lang_ids[ids])
+            batch['net_input']['tgt_lang_id'] = torch.from_numpy(self.tgt_lang_ids[ids])
+        return batch
+
+    def num_tokens(self, index):
+        return max(self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
+
+    def size(self, index):
+        return (self.src_sizes[index], self.tgt_sizes[index] if self.tgt_sizes is not None else 0)
+
+    def ordered_indices(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self))
+        else:
+            indices = np.arange(len(self))
+        if self.tgt_sizes is not None:
+            indices = indices[np.argsort(self.tgt_sizes[indices], kind='mergesort')]
+        return indices[np.argsort(self.src_sizes[indices], kind='mergesort')]
+
+
+@register_task('joint_attention_translation')
+class JointAttentionTranslationTask(TranslationTask):
+    """
+    Translate from one (source) language to another (target) language with
+    batches sized by the cost of the joint source-target self attention.
+
+    Accepts the same arguments as :class:`~fairseq.tasks.translation.TranslationTask`
+    plus *--max-attention-cost*. When it is not given, batching falls back to
+    the default *--max-tokens* / *--max-sentences* behaviour.
+
+    With *--lang-pairs*, a single model with one language embedding per
+    language (*--num-languages*) is trained on all the language pairs. The
+    pairs must share a joined dictionary.
+    """
+
+    @staticmethod
+    def add_args(parser):
+        """Add task-specific arguments to the parser."""
+        TranslationTask.add_args(parser)
+        parser.add_argument('--max-attention-cost', type=int, metavar='N',
+                            help='maximum number of (padded) joint self-attention '
+                                 'query-key pairs per layer in a batch')
+        parser.add_argument('--lang-pairs', metavar='PAIRS',
+                            help='comma-separated list of language pairs (e.g. de-en,en-de,fr-en) '
+                                 'in mixed batches')
+        parser.add_argument('--langs', metavar='LANGS',
+                            help='comma-separated list of languages, the position of a language is its '
+                                 'language id (default: the sorted languages of --lang-pairs)')
+
+    @classmethod
+    def setup_task(cls, args, **kwargs):
+        if getattr(args, 'lang_pairs', None) is not None:
+            lang_pairs = [lang_pair.split('-') for lang_pair in args.lang_pairs.split(',')]
+            if args.langs is None:
+                args.langs = ','.join(sorted({lang for lang_pair in lang_pairs for lang in lang_pair}))
+            # the dictionaries of the first pair are shared by all the pairs
+            args.source_lang, args.target_lang = lang_pairs[0]
+            args.language_embeddings = True
+            args.num_languages = len(args.langs.split(','))
+        return super().setup_task(args, **kwargs)
+
+    def __init__(self, args, src_dict, tgt_dict):
+        super().__init__(args, src_dict, tgt_dict)
+        self.lang_pairs = self.langs = None
+        if getattr(args, 'lang_pairs', None) is not None:
+            self.lang_pairs = [lang_pair.split('-') for lang_pair in args.lang_pairs.split(',')]
+            self.langs = args.langs.split(',')
+
+    def load_dataset(self, split, epoch=0, combine=False, **kwargs):
+        """Load a given dataset split, with all the language pairs of
+        *--lang-pairs*."""
+        if self.lang_pairs is None:
+            return super().load_dataset(split, epoch=epoch, combine=combine, **kwargs)
+
+        paths = self.args.data.split(':')
+        data_path = paths[epoch % len(paths)]
+        datasets, lang_ids = [], []
+        for src, tgt in self.lang_pairs:
+            try:
+                datasets.append(load_langpair_dataset(
+                    data_path, split, src, self.src_dict, tgt, self.tgt_dict,
+                    combine=combine, dataset_impl=self.args.dataset_impl,
+                    upsample_primary=self.args.upsample_primary,
+                    left_pad_source=self.args.left_pad_source,
+                    left_pad_target=self.args.left_pad_target,
+                    max_source_positions=self.args.max_source_positions,
+                    max_target_positions=self.args.max_target_positions,
+                    load_alignments=self.args.load_alignments,
+                    truncate_source=self.args.truncate_source,
+                ))
+            except FileNotFoundError:
+                print('| {} {}-{} not found, skipped'.format(split, src, tgt))
+                continue
+            lang_ids.append((self.langs.index(src), self.langs.index(tgt)))
+        if len(datasets) == 0:
+            raise FileNotFoundError('Dataset not found: {} ({})'.format(split, data_path))
+        self.datasets[split] = LanguagePairsDataset(datasets, lang_ids)
+
+    def get_batch_iterator(
+        self, dataset, max_tokens=None, max_sentences=None, max_positions=None,
+        ignore_invalid_inputs=False, required_batch_size_multiple=1,
+        seed=1, num_shards=1, shard_id=0, num_workers=0, epoch=0,
+    ):
+        max_attention_cost = getattr(self.args, 'max_attention_cost', None)
+        if max_attention_cost is None or not hasattr(dataset, 'src_sizes'):
+            return super().get_batch_iterator(
+                dataset, max_tokens=max_tokens, max_sentences=max_sentences,
+                max_positions=max_positions, ignore_invalid_inputs=ignore_invalid_inputs,
+                required_batch_size_multiple=required_batch_size_multiple,
+                seed=seed, num_shards=num_shards, shard_id=shard_id,
+                num_workers=num_workers, epoch=epoch,
+            )
+
+        if dataset in self.dataset_to_epoch_iter:
+            return self.dataset_to_epoch_iter[dataset]
+
+        # initialize the dataset with the correct starting epoch
+        dataset.set_epoch(epoch)
+
+        # shuffle, then sort by combined source + target length
+        src_sizes, tgt_sizes = dataset.src_sizes, dataset.tgt_sizes
+        with data_utils.numpy_seed(seed):
+            indices = dataset.ordered_indices()
+        joint_sizes = src_sizes[indices] + (tgt_sizes[indices] if tgt_sizes is not None else 0)
+        indices = indices[np.argsort(joint_sizes, kind='mergesort')]
+
+        # filter examples that are too large
+        if max_positions is not None:
+            indices = data_utils.filter_by_size(
+                indices, dataset, max_positions, raise_exception=(not ignore_invalid_inputs),
+            )
+
+        # filter examples that do not fit in a batch on their own
+        indices = filter_by_attention_cost(
+            indices, src_sizes, tgt_sizes, max_attention_cost, raise_exception=(not ignore_invalid_inputs),
+        )
+
+        # create mini-batches bounded by their joint attention cost
+        batch_sampler = batch_by_attention_cost(
+            indices, src_sizes, tgt_sizes, max_attention_cost,
+            max_tokens=max_tokens, max_sentences=max_sentences,
+            required_batch_size_multiple=required_batch_size_multiple,
+        )
+
+        # return a reusable, sharded iterator
+        epoch_iter = iterators.EpochBatchIterator(
+            dataset=dataset,
+            collate_fn=dataset.collater,
+            batch_sampler=batch_sampler,
+            seed=seed,
+            num_shards=num_shards,
+            shard_id=shard_id,
+            num_workers=num_workers,
+            epoch=epoch,
+        )
+        self.dataset_to_epoch_iter[dataset] = epoch_iter
+        return epoch_iter
@@ -21,27 +21,42 @@ class ProtectedMultiheadAttention(nn.Module):
     """Multi-headed attention.
 
     See "Attention Is All You Need" for more details.
+
+    With *num_kv_heads* < *num_heads*, the keys and values are projected to
+    *num_kv_heads* heads, each shared by a group of consecutive query heads
+    (grouped-query attention). Only the shared heads are cached during
+    incremental decoding.
+
+    *head_dim* defaults to ``embed_dim // num_heads``. It is given explicitly
+    for layers that keep only some of their heads after pruning.
     """
 
-    def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False):
+    def __init__(self, embed_dim, num_heads, dropout=0., bias=True, add_bias_kv=False, add_zero_attn=False,
+                 num_kv_heads=None, head_dim=None):
         super().__init__()
         self.embed_dim = embed_dim
         self.num_heads = num_heads
         self.dropout = dropout
-        self.head_dim = embed_dim // num_heads
-        assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
+        if head_dim is None:
+            head_dim = embed_dim // num_heads
+            assert head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
+        self.head_dim = head_dim
         self.scaling = self.head_dim ** -0.5
+        self.num_kv_heads = num_kv_heads or num_heads
+        assert num_heads % self.num_kv_heads == 0, "num_heads must be divisible by num_kv_heads"
+        self.q_dim = self.num_heads * self.head_dim
+        self.kv_dim = self.num_kv_heads * self.head_dim
 
-        self.in_proj_weight = Parameter(torch.Tensor(3 * embed_dim, embed_dim))
+        self.in_proj_weight = Parameter(torch.Tensor(self.q_dim + 2 * self.kv_dim, embed_dim))
         if bias:
-            self.in_proj_bias = Parameter(torch.Tensor(3 * embed_dim))
+            self.in_proj_bias = Parameter(torch.Tensor(self.q_dim + 2 * self.kv_dim))
         else:
             self.register_parameter('in_proj_bias', None)
-        self.out_proj = nn.Linear(embed_dim, embed_dim, bias=bias)
+        self.out_proj = nn.Linear(self.q_dim, embed_dim, bias=bias)
 
         if add_bias_kv:
-            self.bias_k = Parameter(torch.Tensor(1, 1, embed_dim))
-            self.bias_v = Parameter(torch.Tensor(1, 1, embed_dim))
+            self.bias_k = Parameter(torch.Tensor(1, 1, self.kv_dim))
+            self.bias_v = Parameter(torch.Tensor(1, 1, self.kv_dim))
         else:
             self.bias_k = self.bias_v = None
 
@@ -54,6 +69,40 @@ class ProtectedMultiheadAttention(nn.Module):
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
 
+    def make_generation_fast_(self, **kwargs):
+        """Fold the scaling of the queries into their projection.
+
+        The folding is recorded in the *scaling_folded* buffer, so that it is
+        only applied once and a folded state dict is not loaded into a module
+        that scales the queries again.
+        """
+        if hasattr(self, 'scaling_folded'):
+            return
+        self.in_proj_weight.data[:self.q_dim] *= self.scaling
+        if self.in_proj_bias is not None:
+            self.in_proj_bias.data[:self.q_dim] *= self.scaling
+        self.scaling = 1.
+        self.register_buffer('scaling_folded', torch.ones((), dtype=torch.bool))
+
+    def upgrade_state_dict_named(self, state_dict, name):
+        in_proj_weight = state_dict.get(name + '.in_proj_weight')
+        if in_proj_weight is not None and in_proj_weight.size(0) != self.q_dim + 2 * self.kv_dim:
+            kv_heads = (in_proj_weight.size(0) - self.q_dim) // (2 * self.head_dim)
+            raise ValueError(
+                '{} has {} key/value heads in the checkpoint and {} in the model, convert the '
+                'checkpoint with convert_to_gqa.py or set --decoder-kv-heads'.format(
+                    name, kv_heads, self.num_kv_heads)
+            )
+        if name + '.scaling_folded' in state_dict and not hasattr(self, 'scaling_folded'):
+            raise ValueError(
+                '{} was saved after make_generation_fast_() folded the query scaling into '
+                'in_proj_weight, save the model before preparing it for generation'.format(name)
+            )
+
+    def prepare_for_bf16_inference_(self):
+        """Cast the projections to bfloat16. Softmax is still computed in fp32."""
+        self.to(torch.bfloat16)
+
     def reset_parameters(self):
         nn.init.xavier_uniform_(self.in_proj_weight)
         nn.init.xavier_uniform_(self.out_proj.weight)
@@ -66,7 +115,7 @@ class ProtectedMultiheadAttention(nn.Module):
             nn.init.xavier_normal_(self.bias_v)
 
     def forward(self, query, key, value, key_padding_mask=None, incremental_state=None,
-                need_weights=True, static_kv=False, attn_mask=None):
+                need_weights=True, static_kv=False, attn_mask=None, weights_len=None):
         """Input shape: Time x Batch x Channel
 
         Self-attention can be implemented by passing in the same arguments for
@@ -74,6 +123,9 @@ class ProtectedMultiheadAttention(nn.Module):
         `attn_mask` argument. Padding elements can be excluded from
         the key by passing a binary ByteTensor (`key_padding_mask`) with shape:
         batch x src_len, where padding elements are indicated by 1s.
+        With `weights_len`, only the attention weights of the first
+        `weights_len` keys (e.g. the source in the joint self attention) are
+        averaged and returned.
         """
 
         qkv_same = query.data_ptr() == key.data_ptr() == value.data_ptr()
@@ -110,7 +162,11 @@ class ProtectedMultiheadAttention(nn.Module):
             q = self.in_proj_q(query)
             k = self.in_proj_k(key)
             v = self.in_proj_v(value)
-        q *= self.scaling
+        # q is a view of the fused projection: scale out of place so autograd
+        # can track it (required by recent PyTorch versions). The scaling is
+        # folded into the projection for inference
+        if self.scaling != 1.:
+            q = q * self.scaling
 
         if self.bias_k is not None:
             assert self.bias_v is not None
@@ -124,26 +180,26 @@ class ProtectedMultiheadAttention(nn.Module):
 
         q = q.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
         if k is not None:
-            k = k.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+            k = k.contiguous().view(-1, bsz * self.num_kv_heads, self.head_dim).transpose(0, 1)
         if v is not None:
-            v = v.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+            v = v.contiguous().view(-1, bsz * self.num_kv_heads, self.head_dim).transpose(0, 1)
 
         if saved_state is not None:
-            # saved states are stored with shape (bsz, num_heads, seq_len, head_dim)
+            # saved states are stored with shape (bsz, num_kv_heads, seq_len, head_dim)
             if 'prev_key' in saved_state:
-                prev_key = saved_state['prev_key'].view(bsz * self.num_heads, -1, self.head_dim)
+                prev_key = saved_state['prev_key'].view(bsz * self.num_kv_heads, -1, self.head_dim)
                 if static_kv:
                     k = prev_key
                 else:
                     k = torch.cat((prev_key, k), dim=1)
             if 'prev_value' in saved_state:
-                prev_value = saved_state['prev_value'].view(bsz * self.num_heads, -1, self.head_dim)
+                prev_value = saved_state['prev_value'].view(bsz * self.num_kv_heads, -1, self.head_dim)
                 if static_kv:
                     v = prev_value
                 else:
                     v = torch.cat((prev_value, v), dim=1)
-            saved_state['prev_key'] = k.view(bsz, self.num_heads, -1, self.head_dim)
-            saved_state['prev_value'] = v.view(bsz, self.num_heads, -1, self.head_dim)
+            saved_state['prev_key'] = k.view(bsz, self.num_kv_heads, -1, self.head_dim)
+            saved_state['prev_value'] = v.view(bsz, self.num_kv_heads, -1, self.head_dim)
 
             self._set_input_buffer(incremental_state, saved_state)
 
@@ -163,7 +219,11 @@ class ProtectedMultiheadAttention(nn.Module):
                 key_padding_mask = torch.cat(
                     [key_padding_mask, torch.zeros(key_padding_mask.size(0), 1).type_as(key_padding_mask)], dim=1)
 
-        attn_weights = torch.bmm(q, k.transpose(1, 2))
+        # the query heads sharing a key/value head are stacked along the time
+        # dimension, so that the shared keys and values are not repeated
+        group_len = tgt_len * (self.num_heads // self.num_kv_heads)
+        attn_weights = torch.bmm(q.reshape(bsz * self.num_kv_heads, group_len, self.head_dim), k.transpose(1, 2))
+        attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
         assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
 
         if attn_mask is not None:
@@ -198,39 +258,42 @@ class ProtectedMultiheadAttention(nn.Module):
         attn_weights = F.softmax(attn_weights.float(), dim=-1).type_as(attn_weights)
         attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
 
-        attn = torch.bmm(attn_weights, v)
+        attn = torch.bmm(attn_weights.view(bsz * self.num_kv_heads, group_len, src_len), v)
+        attn = attn.view(bsz * self.num_heads, tgt_len, self.head_dim)
         assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
         if (self.onnx_trace and attn.size(1) == 1):
             # when ONNX tracing a single decoder step (sequence length == 1)
             # the transpose is a no-op copy before view, thus unnecessary
-            attn = attn.contiguous().view(tgt_len, bsz, embed_dim)
+            attn = attn.contiguous().view(tgt_len, bsz, self.q_dim)
         else:
-            attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+            attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, self.q_dim)
         attn = self.out_proj(attn)
 
         if need_weights:
             # average attention weights over heads
             attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
-            attn_weights = attn_weights.sum(dim=1) / self.num_heads
+            if weights_len is not None:
+                attn_weights = attn_weights[:, :, :, :weights_len]
+            attn_weights = attn_weights.sum(dim=1).div_(self.num_heads)
         else:
             attn_weights = None
 
         return attn, attn_weights
 
     def in_proj_qkv(self, query):
-        return self._in_proj(query).chunk(3, dim=-1)
+        return self._in_proj(query).split([self.q_dim, self.kv_dim, self.kv_dim], dim=-1)
 
     def in_proj_kv(self, key):
-        return self._in_proj(key, start=self.embed_dim).chunk(2, dim=-1)
+        return self._in_proj(key, start=self.q_dim).chunk(2, dim=-1)
 
     def in_proj_q(self, query):
-        return self._in_proj(query, end=self.embed_dim)
+        return self._in_proj(query, end=self.q_dim)
 
     def in_proj_k(self, key):
-        return self._in_proj(key, start=self.embed_dim, end=2 * self.embed_dim)
+        return self._in_proj(key, start=self.q_dim, end=self.q_dim + self.kv_dim)
 
     def in_proj_v(self, value):
-        return self._in_proj(value, start=2 * self.embed_dim)
+        return self._in_proj(value, start=self.q_dim + self.kv_dim)
 
     def _in_proj(self, input, start=0, end=None):
         weight = self.in_proj_weight
@@ -238,7 +301,7 @@ class ProtectedMultiheadAttention(nn.Module):
         weight = weight[start:end, :]
         if bias is not None:
             bias = bias[start:end]
-        return F.linear(input, weight, bias)
+        return F.linear(input.type_as(weight), weight, bias)
 
     def reorder_incremental_state(self, incremental_state, new_order):
         """Reorder buffered internal state (for incremental generation)."""
@@ -248,6 +311,45 @@ class ProtectedMultiheadAttention(nn.Module):
                 input_buffer[k] = input_buffer[k].index_select(0, new_order)
             self._set_input_buffer(incremental_state, input_buffer)
 
+    def concat_incremental_state(self, incremental_state, other_state, length):
+        """Append the cached rows of *other_state* to *incremental_state*.
+
+        Both caches are left-padded with zeros to *length* positions, so rows
+        with different lengths can share a batch. The padded positions have to
+        be masked by the caller with a key padding mask.
+        """
+        input_buffer = self._get_input_buffer(incremental_state)
+        other_buffer = self._get_input_buffer(other_state)
+        for k in other_buffer.keys():
+            if k in input_buffer:
+                buffers = (input_buffer[k], other_buffer[k])
+                input_buffer[k] = torch.cat([
+                    F.pad(buffer, (0, 0, length - buffer.size(2), 0)) for buffer in buffers
+                ], dim=0)
+            else:
+                input_buffer[k] = F.pad(other_buffer[k], (0, 0, length - other_buffer[k].size(2), 0))
+        self._set_input_buffer(incremental_state, input_buffer)
+
+    def trim_incremental_state(self, incremental_state, start, end=None):
+        """Keep the cached positions from *start* to *end* of every row (by
+        default, drop the first *start* positions)."""
+        input_buffer = self._get_input_buffer(incremental_state)
+        for k in input_buffer.keys():
+            input_buffer[k] = input_buffer[k][:, :, start:end].contiguous()
+        self._set_input_buffer(incremental_state, input_buffer)
+
+    def extend_incremental_state(self, incremental_state, other_state):
+        """Append the cached positions of *other_state*, which has the same
+        rows, after those of *incremental_state*."""
+        input_buffer = self._get_input_buffer(incremental_state)
+        other_buffer = self._get_input_buffer(other_state)
+        for k in other_buffer.keys():
+            if k in input_buffer:
+                input_buffer[k] = torch.cat((input_buffer[k], other_buffer[k]), dim=2)
+            else:
+                input_buffer[k] = other_buffer[k]
+        self._set_input_buffer(incremental_state, input_buffer)
+
     def _get_input_buffer(self, incremental_state):
         return self.get_incremental_state(
             incremental_state,
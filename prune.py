@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Structured pruning of the attention heads and layers of a joint attention model.
+
+The importance of every head and every layer is estimated on a dev set as the
+accumulated absolute gradient of the loss with respect to a gate on its output
+(Michel et al., 2019). The least important layers and heads are removed from
+the checkpoint, which then loads as a smaller architecture, and the BLEU score
+and the decoding speed of each pruned configuration are reported.
+"""
+
+import copy
+import itertools
+import os
+import statistics
+
+import torch
+import torch.nn.functional as F
+
+from fairseq import bleu, checkpoint_utils, options, progress_bar, tasks, utils
+from fairseq.meters import StopwatchMeter
+
+
+def get_parser():
+    parser = options.get_generation_parser()
+    group = parser.add_argument_group('Pruning')
+    # fmt: off
+    group.add_argument('--prune-heads', default='0', type=lambda x: options.eval_str_list(x, int),
+                       metavar='N1,N2,...',
+                       help='numbers of attention heads to remove (key/value head groups for '
+                            'models with --decoder-kv-heads)')
+    group.add_argument('--prune-layers', default='0', type=lambda x: options.eval_str_list(x, int),
+                       metavar='N1,N2,...',
+                       help='numbers of layers to remove, every combination with --prune-heads '
+                            'is evaluated')
+    group.add_argument('--score-subset', default='valid', metavar='SPLIT',
+                       help='data subset used to score the heads and layers')
+    group.add_argument('--max-score-batches', type=int, metavar='N',
+                       help='score the heads and layers on the first N batches only')
+    group.add_argument('--prune-save-dir', metavar='DIR',
+                       help='save the pruned checkpoints to this directory')
+    group.add_argument('--warmup-batches', type=int, default=10, metavar='N',
+                       help='translate N batches untimed before the first timed run')
+    group.add_argument('--timing-runs', type=int, default=1, metavar='N',
+                       help='translate the test set N times per configuration and '
+                            'report the median time')
+    # fmt: on
+    return parser
+
+
+def compute_importance(args, task, model, use_cuda):
+    """Accumulate the absolute gradients of the loss with respect to a gate on
+    the output of each key/value head group and on the residual branch of each
+    layer. Head scores are normalized per layer."""
+    layers = model.decoder.layers
+    head_gates = [
+        torch.ones(layer.self_attn.num_kv_heads, requires_grad=True, device=layer.self_attn.in_proj_weight.device)
+        for layer in layers
+    ]
+    layer_gates = torch.ones(len(layers), requires_grad=True, device=head_gates[0].device)
+
+    def gate_heads(gate):
+        def hook(module, inputs):
+            x = inputs[0]
+            x = x.view(*x.size()[:-1], gate.numel(), -1) * gate.unsqueeze(-1)
+            return x.view(inputs[0].size())
+        return hook
+
+    def gate_layer(gate):
+        def hook(module, inputs, output):
+            x, attn = output
+            return inputs[0] + gate * (x - inputs[0]), attn
+        return hook
+
+    handles = []
+    for i, layer in enumerate(layers):
+        handles.append(layer.self_attn.out_proj.register_forward_pre_hook(gate_heads(head_gates[i])))
+        handles.append(layer.register_forward_hook(gate_layer(layer_gates[i])))
+
+    for param in model.parameters():
+        param.requires_grad_(False)
+    model.eval()
+
+    itr = task.get_batch_iterator(
+        dataset=task.dataset(args.score_subset),
+        max_tokens=args.max_tokens,
+        max_sentences=args.max_sentences,
+        max_positions=utils.resolve_max_positions(task.max_positions(), model.max_positions()),
+        ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test,
+        required_batch_size_multiple=args.required_batch_size_multiple,
+        num_workers=args.num_workers,
+    ).next_epoch_itr(shuffle=False)
+
+    head_importance = [torch.zeros_like(gate) for gate in head_gates]
+    layer_importance = torch.zeros_like(layer_gates)
+    pad = task.target_dictionary.pad()
+    with torch.enable_grad(), progress_bar.build_progress_bar(args, itr, prefix='scoring') as t:
+        for i, sample in enumerate(t):
+            if args.max_score_batches is not None and i >= args.max_score_batches:
+                break
+            sample = utils.move_to_cuda(sample) if use_cuda else sample
+            if 'net_input' not in sample:
+                continue
+            net_output = model(**sample['net_input'])
+            lprobs = model.get_normalized_probs(net_output, log_probs=True)
+            loss = F.nll_loss(
+                lprobs.view(-1, lprobs.size(-1)), sample['target'].view(-1),
+                ignore_index=pad, reduction='sum',
+            )
+            grads = torch.autograd.grad(loss, head_gates + [layer_gates])
+            for importance, grad in zip(head_importance, grads[:-1]):
+                importance += grad.abs()
+            layer_importance += grads[-1].abs()
+
+    for handle in handles:
+        handle.remove()
+
+    head_importance = [importance / importance.norm().clamp(min=1e-20) for importance in head_importance]
+    return [importance.cpu() for importance in head_importance], layer_importance.cpu()
+
+
+def select_pruned(head_importance, layer_importance, num_heads, num_layers):
+    """Return the layers to keep and the head groups to keep in each of them.
+
+    The least important layers are removed first, then the least important
+    heads of the remaining layers, keeping at least one in every layer.
+    """
+    assert num_layers < len(layer_importance), 'cannot remove all the layers'
+    layers = sorted(layer_importance.argsort()[num_layers:].tolist())
+    heads = {i: set(range(len(head_importance[i]))) for i in layers}
+    candidates = sorted(
+        ((head_importance[i][h].item(), i, h) for i in layers for h in heads[i]),
+    )
+    removed = 0
+    for _, i, h in candidates:
+        if removed == num_heads:
+            break
+        if len(heads[i]) > 1:
+            heads[i].remove(h)
+            removed += 1
+    assert removed == num_heads, 'cannot remove {} heads and keep one in each layer'.format(num_heads)
+    return layers, [sorted(heads[i]) for i in layers]
+
+
+def prune_state_dict(state_dict, model_args, layers, heads):
+    """Build the state dict and the arguments of a model that keeps only the
+    given *layers* and, in each of them, the key/value head groups in *heads*."""
+    num_heads = model_args.decoder_attention_heads
+    num_kv_heads = model_args.decoder_kv_heads or num_heads
+    head_dim = model_args.decoder_embed_dim // num_heads
+    group_size = num_heads // num_kv_heads
+    heads_list = model_args.decoder_attention_heads_list or [num_heads] * model_args.decoder_layers
+
+    def rows(groups, size, offset=0):
+        return torch.LongTensor([
+            offset + g * size + j for g in groups for j in range(size)
+        ])
+
+    pruned = {}
+    for key, value in state_dict.items():
+        if not key.startswith('decoder.layers.'):
+            pruned[key] = value
+            continue
+        i, name = key[len('decoder.layers.'):].split('.', 1)
+        if int(i) not in layers:
+            continue
+        j = layers.index(int(i))
+        q_dim = heads_list[int(i)] * head_dim
+        kv_dim = q_dim // group_size
+        if name in ('self_attn.in_proj_weight', 'self_attn.in_proj_bias'):
+            index = torch.cat((
+                rows(heads[j], group_size * head_dim),
+                rows(heads[j], head_dim, offset=q_dim),
+                rows(heads[j], head_dim, offset=q_dim + kv_dim),
+            ))
+            value = value.index_select(0, index)
+        elif name == 'self_attn.out_proj.weight':
+            value = value.index_select(1, rows(heads[j], group_size * head_dim))
+        pruned['decoder.layers.{}.{}'.format(j, name)] = value
+
+    pruned_args = copy.deepcopy(model_args)
+    pruned_args.decoder_layers = len(layers)
+    pruned_args.decoder_attention_heads_list = [len(h) * group_size for h in heads]
+    if pruned_args.decoder_attention_heads_list == [num_heads] * len(layers):
+        pruned_args.decoder_attention_heads_list = None
+    if model_args.kernel_size_list is not None:
+        pruned_args.kernel_size_list = [model_args.kernel_size_list[i] for i in layers]
+    alignment_layer = getattr(model_args, 'alignment_layer', None)
+    if alignment_layer is not None:
+        # the nearest kept layer
+        pruned_args.alignment_layer = min(range(len(layers)), key=lambda j: abs(layers[j] - alignment_layer))
+    return pruned, pruned_args
+
+
+def evaluate(args, task, model, generator, use_cuda, max_batches=None):
+    """Translate *args.gen_subset*, or its first *max_batches* batches, return
+    the BLEU scorer and the timer."""
+    tgt_dict = task.target_dictionary
+    itr = task.get_batch_iterator(
+        dataset=task.dataset(args.gen_subset),
+        max_tokens=args.max_tokens,
+        max_sentences=args.max_sentences,
+        max_positions=utils.resolve_max_positions(task.max_positions(), model.max_positions()),
+        ignore_invalid_inputs=args.skip_invalid_size_inputs_valid_test,
+        required_batch_size_multiple=args.required_batch_size_multiple,
+        num_workers=args.num_workers,
+    ).next_epoch_itr(shuffle=False)
+
+    gen_timer = StopwatchMeter()
+    scorer = bleu.Scorer(tgt_dict.pad(), tgt_dict.eos(), tgt_dict.unk())
+    with progress_bar.build_progress_bar(args, itr, prefix='generating') as t:
+        for i, sample in enumerate(t):
+            if max_batches is not None and i >= max_batches:
+                break
+            sample = utils.move_to_cuda(sample) if use_cuda else sample
+            if 'net_input' not in sample:
+                continue
+            gen_timer.start()
+            hypos = task.inference_step(generator, [model], sample)
+            gen_timer.stop(sum(len(h[0]['tokens']) for h in hypos))
+
+            for i in range(len(hypos)):
+                target_tokens = utils.strip_pad(sample['target'][i, :], tgt_dict.pad()).int().cpu()
+                hypo_tokens = hypos[i][0]['tokens'].int().cpu()
+                if args.remove_bpe is not None:
+                    # score without BPE
+                    target_tokens = tgt_dict.encode_line(
+                        tgt_dict.string(target_tokens, args.remove_bpe, escape_unk=True), add_if_not_exist=True)
+                    hypo_tokens = tgt_dict.encode_line(
+                        tgt_dict.string(hypo_tokens, args.remove_bpe), add_if_not_exist=True)
+                scorer.add(target_tokens, hypo_tokens)
+    return scorer, gen_timer
+
+
+def main(args):
+    assert args.path is not None, '--path required for pruning!'
+    assert len(args.path.split(':')) == 1, 'ensembles cannot be pruned'
+
+    utils.import_user_module(args)
+
+    if args.max_tokens is None and args.max_sentences is None:
+        args.max_tokens = 12000
+    print(args)
+
+    use_cuda = torch.cuda.is_available() and not args.cpu
+
+    # Load dataset splits
+    task = tasks.setup_task(args)
+    task.load_dataset(args.score_subset)
+    task.load_dataset(args.gen_subset)
+
+    # Load the model
+    print('| loading model from {}'.format(args.path))
+    models, model_args = checkpoint_utils.load_model_ensemble(
+        [args.path], arg_overrides=eval(args.model_overrides), task=task,
+    )
+    model = models[0]
+    if use_cuda:
+        model.cuda()
+    state_dict = {key: value.cpu() for key, value in model.state_dict().items()}
+
+    head_importance, layer_importance = compute_importance(args, task, model, use_cuda)
+    print('| layer importance: {}'.format(' '.join('{:.4f}'.format(x) for x in layer_importance.tolist())))
+    for i, importance in enumerate(head_importance):
+        print('| layer {} head importance: {}'.format(i, ' '.join('{:.4f}'.format(x) for x in importance.tolist())))
+
+    generator = task.build_generator(args)
+    configurations = sorted(set(itertools.product(args.prune_heads, args.prune_layers)) | {(0, 0)})
+    results = []
+    for num_heads, num_layers in configurations:
+        layers, heads = select_pruned(head_importance, layer_importance, num_heads, num_layers)
+        pruned_state_dict, pruned_args = prune_state_dict(state_dict, model_args, layers, heads)
+        pruned_model = task.build_model(pruned_args)
+        pruned_model.load_state_dict(pruned_state_dict)
+        pruned_model.make_generation_fast_(beamable_mm_beam_size=None if args.no_beamable_mm else args.beam)
+        if args.fp16:
+            pruned_model.half()
+        if use_cuda:
+            pruned_model.cuda()
+
+        if not results and args.warmup_batches > 0:
+            # the first configuration is the speedup baseline, do not time it cold
+            evaluate(args, task, pruned_model, generator, use_cuda, max_batches=args.warmup_batches)
+        scorer, gen_timer = evaluate(args, task, pruned_model, generator, use_cuda)
+        times = [gen_timer.sum]
+        for _ in range(args.timing_runs - 1):
+            times.append(evaluate(args, task, pruned_model, generator, use_cuda)[1].sum)
+        num_params = sum(p.numel() for p in pruned_model.parameters())
+        results.append((
+            num_heads, num_layers, num_params, scorer.score(), statistics.median(times), gen_timer.n,
+        ))
+        print('| pruned {} heads and {} layers: kept layers {}, heads per layer {}: {}'.format(
+            num_heads, num_layers, layers, [len(h) for h in heads], scorer.result_string()))
+
+        if args.prune_save_dir is not None:
+            os.makedirs(args.prune_save_dir, exist_ok=True)
+            state = checkpoint_utils.load_checkpoint_to_cpu(args.path)
+            state['args'] = pruned_args
+            state['model'] = pruned_state_dict
+            # the optimizer state does not match the pruned parameters
+            state.pop('last_optimizer_state', None)
+            filename = os.path.join(
+                args.prune_save_dir, 'checkpoint_pruned_h{}_l{}.pt'.format(num_heads, num_layers))
+            checkpoint_utils.torch_persistent_save(state, filename)
+            print('| saved {}'.format(filename))
+
+    base_time = results[0][4]
+    print('| {:>6} {:>7} {:>11} {:>6} {:>8} {:>9} {:>8}'.format(
+        'heads', 'layers', 'params', 'BLEU', 'time', 'tokens/s', 'speedup'))
+    for num_heads, num_layers, num_params, score, time, num_tokens in results:
+        print('| {:>6} {:>7} {:>11} {:>6.2f} {:>7.1f}s {:>9.1f} {:>7.2f}x'.format(
+            num_heads, num_layers, num_params, score, time, num_tokens / time, base_time / time))
+
+
+def cli_main():
+    parser = get_parser()
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
@@ -7,11 +7,18 @@
 # can be found in the PATENTS file in the same directory.
 """
 BLEU scoring of generated translations against reference translations.
+
+With --generate-output, the output of fairseq-generate is scored directly
+while it is being generated, e.g.:
+
+    fairseq-generate ... | python score.py --generate-output --report-every 500
 """
 
 import argparse
 import os
+import re
 import sys
+from collections import Counter
 
 from fairseq import bleu, tokenizer
 from fairseq.data import dictionary
@@ -21,17 +28,109 @@ def get_parser():
     parser = argparse.ArgumentParser(description='Command-line script for BLEU scoring.')
     # fmt: off
     parser.add_argument('-s', '--sys', default='-', help='system output')
-    parser.add_argument('-r', '--ref', required=True, help='references')
+    parser.add_argument('-r', '--ref', help='references (not used with --generate-output)')
     parser.add_argument('-o', '--order', default=4, metavar='N',
                         type=int, help='consider ngrams up to this order')
     parser.add_argument('--ignore-case', action='store_true',
                         help='case-insensitive scoring')
     parser.add_argument('--sacrebleu', action='store_true',
                         help='score with sacrebleu')
+    parser.add_argument('--generate-output', action='store_true',
+                        help='the system output is the output of fairseq-generate: the hypotheses '
+                             '(H-) are matched with the references (T-) by sentence id and scored '
+                             'as soon as both have been read')
+    parser.add_argument('--report-every', type=int, metavar='N',
+                        help='with --generate-output, report the scores of the sentences read so '
+                             'far every N sentences')
+    parser.add_argument('--remove-bpe', nargs='?', const='@@ ', default=None,
+                        help='remove BPE tokens before scoring (can be set to sentencepiece)')
+    parser.add_argument('--compound-split', action='store_true',
+                        help='split hyphenated compounds (a-b -> a ##AT##-##AT## b) before scoring, '
+                             'as compound_split_bleu.sh')
+    parser.add_argument('--chrf', action='store_true',
+                        help='also report chrF (computed by sacrebleu with --sacrebleu)')
     # fmt: on
     return parser
 
 
+class ChrFScorer(object):
+    """Corpus-level chrF (Popović, 2015) with the defaults of sacrebleu:
+    character n-grams up to order 6 without whitespace, averaged over the
+    orders, and beta 2. The n-gram statistics are accumulated sentence by
+    sentence."""
+
+    def __init__(self, order=6, beta=2):
+        self.order = order
+        self.beta = beta
+        # hypothesis, reference and matching n-grams of each order
+        self.stats = [[0, 0, 0] for _ in range(order)]
+
+    def add(self, ref, pred):
+        ref, pred = ''.join(ref.split()), ''.join(pred.split())
+        for n in range(1, self.order + 1):
+            ref_ngrams = Counter(ref[i:i + n] for i in range(len(ref) - n + 1))
+            pred_ngrams = Counter(pred[i:i + n] for i in range(len(pred) - n + 1))
+            stats = self.stats[n - 1]
+            # as sacrebleu, hypothesis n-grams only count if the reference
+            # has n-grams of that order
+            if len(ref_ngrams) > 0:
+                stats[0] += sum(pred_ngrams.values())
+            stats[1] += sum(ref_ngrams.values())
+            stats[2] += sum((ref_ngrams & pred_ngrams).values())
+
+    def score(self):
+        precision = recall = 0.
+        effective_order = 0
+        for num_pred, num_ref, num_match in self.stats:
+            if num_pred > 0 and num_ref > 0:
+                precision += num_match / num_pred
+                recall += num_match / num_ref
+                effective_order += 1
+        if effective_order == 0:
+            return 0.
+        precision /= effective_order
+        recall /= effective_order
+        if precision + recall == 0:
+            return 0.
+        factor = self.beta ** 2
+        return 100 * (1 + factor) * precision * recall / (factor * precision + recall)
+
+    def result_string(self):
+        return 'chrF{} = {:.2f}'.format(self.beta, self.score())
+
+
+def read_generate_output(fd):
+    """Yield ``(id, hypothesis, reference)`` tuples from the output of
+    fairseq-generate as soon as both lines of a sentence have been read. Only
+    the best hypothesis of each sentence is kept."""
+    refs, hyps, done = {}, {}, set()
+    for line in fd:
+        if line.startswith('T-'):
+            sample_id, ref = line[2:].split('\t', 1)
+            sample_id = int(sample_id)
+            refs[sample_id] = ref
+        elif line.startswith('H-'):
+            sample_id, _score, hyp = line[2:].split('\t', 2)
+            sample_id = int(sample_id)
+            if sample_id in hyps or sample_id in done:
+                continue
+            hyps[sample_id] = hyp
+        else:
+            continue
+        if sample_id in refs and sample_id in hyps:
+            done.add(sample_id)
+            yield sample_id, hyps.pop(sample_id), refs.pop(sample_id)
+    if len(hyps) > 0:
+        print('| WARNING: {} hypotheses without reference were not scored'.format(len(hyps)))
+
+
+def encode_line(dict, line):
+    if hasattr(tokenizer, 'Tokenizer'):
+        return tokenizer.Tokenizer.tokenize(line, dict)
+    # fairseq >= 0.8
+    return dict.encode_line(line)
+
+
 def main():
     parser = get_parser()
     args = parser.parse_args()
@@ -39,33 +138,74 @@ def main():
 
     assert args.sys == '-' or os.path.exists(args.sys), \
         "System output file {} does not exist".format(args.sys)
-    assert os.path.exists(args.ref), \
+    assert args.generate_output or args.ref is not None, \
+        "--ref is required unless scoring --generate-output"
+    assert args.generate_output or os.path.exists(args.ref), \
         "Reference file {} does not exist".format(args.ref)
 
     dict = dictionary.Dictionary()
 
+    def preprocess(line):
+        if args.ignore_case:
+            line = line.lower()
+        if args.remove_bpe is not None:
+            line = (line.rstrip('\n') + ' ').replace(args.remove_bpe, '').rstrip() + '\n'
+        if args.compound_split:
+            line = re.sub(r'(\S)-(\S)', r'\1 ##AT##-##AT## \2', line)
+        return line
+
     def readlines(fd):
         for line in fd.readlines():
-            if args.ignore_case:
-                yield line.lower()
-            else:
-                yield line
+            yield preprocess(line)
 
-    if args.sacrebleu:
+    def print_sacrebleu(sys_lines, ref_lines):
         import sacrebleu
+        print(sacrebleu.corpus_bleu(sys_lines, [ref_lines]))
+        if args.chrf:
+            print(sacrebleu.corpus_chrf(sys_lines, [ref_lines]))
+
+    def result_string(scorer, chrf):
+        result = scorer.result_string(args.order)
+        if chrf is not None:
+            result += ', ' + chrf.result_string()
+        return result
 
+    if args.generate_output:
+        def score(fdsys):
+            scorer = bleu.Scorer(dict.pad(), dict.eos(), dict.unk())
+            chrf = ChrFScorer() if args.chrf else None
+            sentences = []
+            for i, (sample_id, sys_tok, ref_tok) in enumerate(read_generate_output(fdsys), 1):
+                sys_tok, ref_tok = preprocess(sys_tok), preprocess(ref_tok)
+                scorer.add(encode_line(dict, ref_tok), encode_line(dict, sys_tok))
+                if chrf is not None:
+                    chrf.add(ref_tok, sys_tok)
+                if args.sacrebleu:
+                    sentences.append((sample_id, sys_tok, ref_tok))
+                if args.report_every is not None and i % args.report_every == 0:
+                    print('| {} sentences: {}'.format(i, result_string(scorer, chrf)))
+                    sys.stdout.flush()
+            if args.sacrebleu:
+                sentences.sort()
+                print_sacrebleu([s[1] for s in sentences], [s[2] for s in sentences])
+            else:
+                print(result_string(scorer, chrf))
+    elif args.sacrebleu:
         def score(fdsys):
             with open(args.ref) as fdref:
-                print(sacrebleu.corpus_bleu(fdsys, [fdref]))
+                print_sacrebleu(list(readlines(fdsys)), list(readlines(fdref)))
     else:
         def score(fdsys):
             with open(args.ref) as fdref:
                 scorer = bleu.Scorer(dict.pad(), dict.eos(), dict.unk())
+                chrf = ChrFScorer() if args.chrf else None
                 for sys_tok, ref_tok in zip(readlines(fdsys), readlines(fdref)):
-                    sys_tok = tokenizer.Tokenizer.tokenize(sys_tok, dict)
-                    ref_tok = tokenizer.Tokenizer.tokenize(ref_tok, dict)
+                    if chrf is not None:
+                        chrf.add(ref_tok, sys_tok)
+                    sys_tok = encode_line(dict, sys_tok)
+                    ref_tok = encode_line(dict, ref_tok)
                     scorer.add(ref_tok, sys_tok)
-                print(scorer.result_string(args.order))
+                print(result_string(scorer, chrf))
 
     if args.sys == '-':
         score(sys.stdin)
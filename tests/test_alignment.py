@@ -0,0 +1,28 @@
+import unittest
+
+import torch
+
+from tests.utils import build_model, dummy_batch
+
+
+class TestAlignmentLayer(unittest.TestCase):
+
+    def test_attention(self):
+        model, d = build_model(alignment_layer=-1)
+        self.assertEqual(model.decoder.alignment_layer, 2)
+        model.make_generation_fast_(need_attn=True)
+        src_tokens, src_lengths, prev_output_tokens = dummy_batch(d)
+        with torch.no_grad():
+            _, extra = model(src_tokens, src_lengths, prev_output_tokens)
+        self.assertEqual(extra['attn'].size(), (src_tokens.size(0), prev_output_tokens.size(1), src_tokens.size(1)))
+        # the source slice of the attention over the source and the target
+        self.assertTrue(extra['attn'].sum(dim=-1).le(1 + 1e-6).all())
+
+    def test_out_of_range(self):
+        for alignment_layer in (3, -4):
+            with self.assertRaisesRegex(ValueError, '--alignment-layer'):
+                build_model(alignment_layer=alignment_layer)
+
+
+if __name__ == '__main__':
+    unittest.main()
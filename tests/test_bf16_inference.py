@@ -0,0 +1,85 @@
+import copy
+import unittest
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+
+from tests.utils import build_model, dummy_batch
+
+
+# bfloat16 keeps 8 bits of mantissa: the logits may differ from fp32 by about
+# 1% of their magnitude, the output distributions by much less
+LOGITS_RTOL = 0.02
+PROBS_ATOL = 0.01
+
+
+def greedy_decode(model, src_tokens, src_lengths, eos, max_len=8):
+    encoder_out = model.encoder(src_tokens, src_lengths)
+    tokens = src_tokens.new_full((src_tokens.size(0), 1), eos)
+    incremental_state = {}
+    for _ in range(max_len):
+        logits, _ = model.decoder(tokens, encoder_out, incremental_state=incremental_state)
+        tokens = torch.cat((tokens, logits[:, -1].argmax(dim=-1, keepdim=True)), dim=1)
+    return tokens
+
+
+class TestBF16Inference(unittest.TestCase):
+
+    def _models(self, qk_scale=1., **kwargs):
+        model, d = build_model(layers=4, embed_dim=64, heads=4, **kwargs)
+        with torch.no_grad():
+            for layer in model.decoder.layers:
+                attn = layer.self_attn
+                attn.in_proj_weight[:attn.q_dim + attn.kv_dim].mul_(qk_scale)
+        bf16_model = copy.deepcopy(model)
+        model.make_generation_fast_()
+        bf16_model.decoder.bf16_inference = True
+        bf16_model.make_generation_fast_()
+        return model, bf16_model, d
+
+    def _test_outputs(self, min_attn_logit=None, **kwargs):
+        model, bf16_model, d = self._models(**kwargs)
+        src_tokens, src_lengths, prev_output_tokens = dummy_batch(d, bsz=4, src_len=9, tgt_len=7)
+        with torch.no_grad():
+            with mock.patch.object(F, 'softmax', wraps=F.softmax) as softmax:
+                logits, _ = model(src_tokens, src_lengths, prev_output_tokens)
+            if min_attn_logit is not None:
+                scores = torch.cat([call.args[0].flatten() for call in softmax.call_args_list])
+                self.assertGreater(scores[torch.isfinite(scores)].abs().max().item(), min_attn_logit)
+            bf16_logits, _ = bf16_model(src_tokens, src_lengths, prev_output_tokens)
+            self.assertEqual(bf16_logits.dtype, torch.float32)
+            self.assertLessEqual(
+                (logits - bf16_logits).abs().max().item(), LOGITS_RTOL * logits.abs().max().item())
+            probs = model.get_normalized_probs((logits, None), log_probs=False)
+            bf16_probs = bf16_model.get_normalized_probs((bf16_logits, None), log_probs=False)
+            self.assertLessEqual((probs - bf16_probs).abs().max().item(), PROBS_ATOL)
+
+            self.assertTrue(torch.equal(
+                greedy_decode(model, src_tokens, src_lengths, d.eos()),
+                greedy_decode(bf16_model, src_tokens, src_lengths, d.eos()),
+            ))
+
+    def test_outputs_match_fp32(self):
+        self._test_outputs()
+
+    def test_outputs_match_fp32_normalize_before(self):
+        self._test_outputs(normalize_before=True)
+
+    def test_outputs_match_fp32_large_attention_logits(self):
+        # the scores of a small random model are small; scale the queries and
+        # keys to the attention logits of trained models, which reach tens
+        self._test_outputs(qk_scale=3., min_attn_logit=30.)
+
+    def test_bf16_weights(self):
+        _, bf16_model, _ = self._models()
+        layer = bf16_model.decoder.layers[0]
+        self.assertEqual(layer.self_attn.in_proj_weight.dtype, torch.bfloat16)
+        self.assertEqual(layer.fc1.weight.dtype, torch.bfloat16)
+        # softmax inputs and layer norms stay in fp32
+        self.assertEqual(layer.self_attn_layer_norm.weight.dtype, torch.float32)
+        self.assertEqual(bf16_model.decoder.embed_tokens.weight.dtype, torch.float32)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import copy
+import unittest
+
+import torch
+
+from tests.utils import build_model, dummy_batch
+
+
+class TestConstantFolding(unittest.TestCase):
+
+    def setUp(self):
+        self.model, d = build_model()
+        self.batch = dummy_batch(d)
+        with torch.no_grad():
+            self.expected = self.model(*self.batch)[0]
+
+    def logits(self, model):
+        with torch.no_grad():
+            return model(*self.batch)[0]
+
+    def test_outputs(self):
+        self.model.make_generation_fast_()
+        self.assertTrue(torch.allclose(self.logits(self.model), self.expected, atol=1e-5))
+
+    def test_fold_twice(self):
+        self.model.make_generation_fast_()
+        folded = copy.deepcopy(self.model.state_dict())
+        self.model.fold_embedding_constants_()
+        for module in self.model.modules():
+            if hasattr(module, 'scaling_folded'):
+                module.make_generation_fast_()
+        for key, value in self.model.state_dict().items():
+            self.assertTrue(torch.equal(value, folded[key]), key)
+        self.assertTrue(torch.allclose(self.logits(self.model), self.expected, atol=1e-5))
+
+    def test_reload_before_folding(self):
+        state_dict = copy.deepcopy(self.model.state_dict())
+        self.model.make_generation_fast_()
+        reloaded, _ = build_model(seed=1)
+        reloaded.load_state_dict(state_dict)
+        reloaded.make_generation_fast_()
+        self.assertTrue(torch.allclose(self.logits(reloaded), self.logits(self.model)))
+
+    def test_reload_after_folding(self):
+        self.model.make_generation_fast_()
+        reloaded, _ = build_model(seed=1)
+        with self.assertRaises(ValueError):
+            reloaded.load_state_dict(copy.deepcopy(self.model.state_dict()))
+
+    def test_reload_attention_after_folding(self):
+        self.model.make_generation_fast_()
+        state_dict = {
+            key: value for key, value in self.model.state_dict().items()
+            if key != 'constants_folded'
+        }
+        reloaded, _ = build_model(seed=1)
+        with self.assertRaisesRegex(ValueError, 'query scaling'):
+            reloaded.load_state_dict(state_dict)
+
+
+if __name__ == '__main__':
+    unittest.main()
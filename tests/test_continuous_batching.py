@@ -0,0 +1,96 @@
+import unittest
+
+import torch
+
+from models.continuous_batching import ContinuousBatchGenerator
+from tests.utils import build_model
+
+MAX_LEN_A, MAX_LEN_B = 1, 3
+
+
+def requests(d, num_requests=10, seed=3):
+    g = torch.Generator().manual_seed(seed)
+    for i, length in enumerate(torch.randint(1, 12, (num_requests,), generator=g).tolist()):
+        src_tokens = torch.randint(d.nspecial, len(d), (length + 1,), generator=g)
+        src_tokens[-1] = d.eos()
+        yield i, src_tokens
+
+
+def greedy(model, d, src_tokens):
+    """Greedy decoding of a single sentence."""
+    encoder_out = model.encoder(src_tokens.unsqueeze(0), torch.LongTensor([src_tokens.numel()]))
+    state = {}
+    tokens = torch.LongTensor([[d.eos()]])
+    max_len = src_tokens.numel() * MAX_LEN_A + MAX_LEN_B
+    while tokens.size(1) <= max_len and (tokens.size(1) == 1 or tokens[0, -1] != d.eos()):
+        step_logits = model.decoder(tokens, encoder_out, incremental_state=state)[0][:, -1]
+        step_logits[:, d.pad()] = -float('inf')
+        tokens = torch.cat((tokens, step_logits.argmax(dim=-1, keepdim=True)), dim=1)
+    return tokens[0, 1:]
+
+
+class TestContinuousBatching(unittest.TestCase):
+
+    def _test_generate(self, **kwargs):
+        model, d = build_model(**kwargs)
+        generator = ContinuousBatchGenerator(model, d, max_batch_size=3, max_len_a=MAX_LEN_A, max_len_b=MAX_LEN_B)
+        outputs = dict(generator.generate(requests(d)))
+        self.assertEqual(len(outputs), 10)
+        with torch.no_grad():
+            for i, src_tokens in requests(d):
+                self.assertTrue(torch.equal(outputs[i], greedy(model, d, src_tokens)), i)
+
+    def test_generate(self):
+        self._test_generate()
+
+    def test_generate_without_kernel_sizes(self):
+        self._test_generate(kernel_sizes=False)
+
+    def test_generate_kv_heads(self):
+        self._test_generate(decoder_kv_heads=2)
+
+    def test_generate_kv_heads_without_kernel_sizes(self):
+        self._test_generate(kernel_sizes=False, decoder_kv_heads=2)
+
+    def _test_reorder_and_trim(self, **kwargs):
+        model, d = build_model(**kwargs)
+        decoder = model.decoder
+        generator = ContinuousBatchGenerator(model, d, max_len_a=MAX_LEN_A, max_len_b=MAX_LEN_B)
+        sentences = [src_tokens for _, src_tokens in requests(d, num_requests=4, seed=4)]
+        longest = max(range(4), key=lambda i: sentences[i].numel())
+        with torch.no_grad():
+            state, tokens, _, _ = generator.prefill(sentences, [None] * 4, [None] * 4)
+            width = decoder.get_ragged_state(state)['key_padding_mask'].size(1)
+
+            # drop the longest sentence and reverse the others
+            order = torch.LongTensor([i for i in reversed(range(4)) if i != longest])
+            decoder.reorder_incremental_state(state, order)
+            decoder.trim_incremental_state_(state)
+            tokens = generator.trim_tokens(tokens.index_select(0, order))
+            key_padding_mask = decoder.get_ragged_state(state)['key_padding_mask']
+            self.assertLess(key_padding_mask.size(1), width)
+            self.assertFalse(key_padding_mask.all(dim=0).any())
+            for module in model.modules():
+                if hasattr(module, 'kv_dim'):
+                    prev_key = module._get_input_buffer(state)['prev_key']
+                    self.assertEqual(prev_key.size(0), 3)
+                    self.assertEqual(prev_key.size(2), key_padding_mask.size(1))
+
+            encoder_out = {'encoder_out': None, 'encoder_padding_mask': None}
+            logits = decoder(tokens, encoder_out, incremental_state=state)[0][:, -1]
+            for row, i in enumerate(order.tolist()):
+                # full forward of the sentence on its own
+                prev_output_tokens = tokens[row, tokens[row].ne(d.pad())].unsqueeze(0)
+                expected = model(sentences[i].unsqueeze(0), torch.LongTensor([sentences[i].numel()]),
+                                 prev_output_tokens)[0][0, -1]
+                self.assertTrue(torch.allclose(logits[row], expected, atol=1e-5), i)
+
+    def test_reorder_and_trim(self):
+        self._test_reorder_and_trim()
+
+    def test_reorder_and_trim_kv_heads_without_kernel_sizes(self):
+        self._test_reorder_and_trim(kernel_sizes=False, decoder_kv_heads=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
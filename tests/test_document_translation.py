@@ -0,0 +1,90 @@
+import unittest
+
+import torch
+
+from fairseq import utils
+
+from models.document_translation import DocumentTranslator
+from tests.utils import build_model
+
+
+def sentences(d, lengths, seed=2):
+    g = torch.Generator().manual_seed(seed)
+    return [torch.randint(d.nspecial, len(d), (length,), generator=g) for length in lengths]
+
+
+class TestDocumentTranslation(unittest.TestCase):
+
+    def test_defaults_translate_chunks_independently(self):
+        model, d = build_model()
+        translator = DocumentTranslator(model, d, chunk_tokens=8, max_len_a=1., max_len_b=2)
+        self.assertEqual((translator.overlap, translator.carry), (0, 0))
+        document = sentences(d, [5, 3, 6, 4, 7])
+        chunks = list(translator.chunks(document))
+        self.assertGreater(len(chunks), 1)
+        expected = torch.cat([translator.translate([chunk])[:-1] for chunk in chunks] + [torch.LongTensor([d.eos()])])
+        self.assertTrue(torch.equal(translator.translate(document), expected))
+
+    def test_carry_target(self):
+        model, d = build_model()
+        translator = DocumentTranslator(model, d, chunk_tokens=8, overlap=2, carry_target=True)
+        self.assertEqual((translator.overlap, translator.carry), (2, max(model.decoder.kernel_size_list) - 1))
+        self.assertEqual(translator.translate(sentences(d, [5, 3, 6]))[-1], d.eos())
+
+    def target_positions(self, translator, document):
+        """Translate *document*, return the position of the target token fed
+        at every decoding step, in a list per chunk."""
+        decoder = translator.model.decoder
+        padding_idx = decoder.embed_tokens.padding_idx
+        chunks = []
+
+        def hook(module, args, kwargs):
+            prev_output_tokens, state = args[0], kwargs['incremental_state']
+            if len(state) == 0:
+                # the source of a new chunk
+                chunks.append([])
+            else:
+                positions = utils.make_positions(prev_output_tokens, padding_idx)
+                chunks[-1].append(int(positions[0, -1]) - padding_idx)
+
+        handle = decoder.register_forward_pre_hook(hook, with_kwargs=True)
+        try:
+            translator.translate(document)
+        finally:
+            handle.remove()
+        return chunks
+
+    def test_carry_target_positions(self):
+        model, d = build_model()
+        translator = DocumentTranslator(model, d, chunk_tokens=8, carry_target=True, max_len_a=1., max_len_b=2)
+        chunks = self.target_positions(translator, sentences(d, [5, 3, 6, 4, 7]))
+        self.assertGreater(len(chunks), 2)
+        # the target positions continue across the chunk boundaries
+        positions = [position for chunk in chunks for position in chunk]
+        self.assertEqual(positions, list(range(1, len(positions) + 1)))
+
+        translator = DocumentTranslator(model, d, chunk_tokens=8, max_len_a=1., max_len_b=2)
+        for chunk in self.target_positions(translator, sentences(d, [5, 3, 6, 4, 7])):
+            self.assertEqual(chunk, list(range(1, len(chunk) + 1)))
+
+    def test_carry_target_max_positions(self):
+        model, d = build_model(max_target_positions=20)
+        translator = DocumentTranslator(model, d, chunk_tokens=8, carry_target=True, max_len_a=1., max_len_b=2)
+        chunks = self.target_positions(translator, sentences(d, [5, 3, 6, 4, 7, 8, 2, 6]))
+        self.assertLessEqual(max(chunk[-1] for chunk in chunks), model.decoder.max_positions())
+        # a chunk that could exceed the maximum positions starts over
+        self.assertIn(1, [chunk[0] for chunk in chunks[1:]])
+        self.assertNotEqual([chunk[0] for chunk in chunks[1:]], [1] * (len(chunks) - 1))
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertIn(chunk[0], (1, previous[-1] + 1))
+
+    def test_language_ids(self):
+        model, d = build_model(language_embeddings=True, num_languages=3)
+        translator = DocumentTranslator(model, d, chunk_tokens=8, max_len_a=1., max_len_b=2)
+        document = sentences(d, [5, 3, 6])
+        translations = [translator.translate(document, 0, tgt_lang_id) for tgt_lang_id in (1, 2)]
+        self.assertFalse(torch.equal(*translations))
+
+
+if __name__ == '__main__':
+    unittest.main()
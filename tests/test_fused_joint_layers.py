@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+
+import torch
+
+from tests.utils import build_model, dummy_batch
+
+
+class TestFusedJointLayers(unittest.TestCase):
+
+    def _test_outputs(self, **kwargs):
+        model, d = build_model(**kwargs)
+        fused, _ = build_model(fused_joint_layers=True, **kwargs)
+        batch = dummy_batch(d)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(model(*batch)[0], fused(*batch)[0], atol=1e-5))
+
+    def test_outputs(self):
+        self._test_outputs()
+
+    def test_outputs_without_kernel_sizes(self):
+        self._test_outputs(kernel_sizes=False)
+
+    def test_outputs_normalize_before(self):
+        self._test_outputs(normalize_before=True)
+
+    def test_default_no_limit(self):
+        model, d = build_model(fused_joint_layers=True)
+        self.assertIsNone(model.decoder.fused_joint_max_tokens)
+        batch = dummy_batch(d, bsz=64, src_len=30, tgt_len=30)
+        with mock.patch.object(model.decoder, 'joint_mask', wraps=model.decoder.joint_mask) as joint_mask:
+            with torch.no_grad():
+                model(*batch)
+        self.assertTrue(joint_mask.called)
+
+    def test_batch_shape(self):
+        model, d = build_model(fused_joint_layers=True, fused_joint_max_tokens=3 * (7 + 5))
+        for bsz, used in ((3, True), (4, False)):
+            batch = dummy_batch(d, bsz=bsz, src_len=7, tgt_len=5)
+            with mock.patch.object(model.decoder, 'joint_mask', wraps=model.decoder.joint_mask) as joint_mask:
+                with torch.no_grad():
+                    model(*batch)
+            self.assertEqual(joint_mask.called, used)
+
+
+if __name__ == '__main__':
+    unittest.main()
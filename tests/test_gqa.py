@@ -0,0 +1,65 @@
+import copy
+import unittest
+
+import torch
+
+from convert_to_gqa import convert_state_dict
+from tests.utils import build_model, dummy_batch
+from tests.test_inference_layer import incremental_logits
+
+EMBED_DIM, HEADS, KV_HEADS = 32, 4, 2
+
+
+def share_kv_heads_(model):
+    """Make the key/value heads equal within each group of the GQA model."""
+    group = HEADS // KV_HEADS
+    for layer in model.decoder.layers:
+        attn = layer.self_attn
+        with torch.no_grad():
+            for param in (attn.in_proj_weight, attn.in_proj_bias):
+                param.normal_(std=0.1)
+                kv = param[attn.q_dim:].view(2, KV_HEADS, group, attn.head_dim, *param.size()[1:])
+                kv.copy_(kv[:, :, :1].expand_as(kv).clone())
+
+
+class TestGroupedQueryAttention(unittest.TestCase):
+
+    def setUp(self):
+        self.model, self.d = build_model(embed_dim=EMBED_DIM, heads=HEADS)
+        share_kv_heads_(self.model)
+        state_dict = copy.deepcopy(self.model.state_dict())
+        num_converted = convert_state_dict(state_dict, EMBED_DIM, HEADS, HEADS, KV_HEADS)
+        self.assertEqual(num_converted, 2 * len(self.model.decoder.layers))
+        self.gqa_model, _ = build_model(embed_dim=EMBED_DIM, heads=HEADS, seed=1, decoder_kv_heads=KV_HEADS)
+        self.gqa_model.load_state_dict(state_dict)
+        self.batch = dummy_batch(self.d)
+
+    def test_outputs(self):
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(self.model(*self.batch)[0], self.gqa_model(*self.batch)[0], atol=1e-5))
+            self.assertTrue(torch.allclose(
+                incremental_logits(self.model, *self.batch), incremental_logits(self.gqa_model, *self.batch), atol=1e-5))
+
+    def test_cache(self):
+        src_tokens, src_lengths, prev_output_tokens = self.batch
+        with torch.no_grad():
+            encoder_out = self.gqa_model.encoder(src_tokens, src_lengths)
+            state = {}
+            for step in range(3):
+                self.gqa_model.decoder(prev_output_tokens[:, :step + 1], encoder_out, incremental_state=state)
+            new_order = torch.LongTensor([2, 0, 0, 1])
+            self.gqa_model.decoder.reorder_incremental_state(state, new_order)
+        for layer in self.gqa_model.decoder.layers:
+            buffer = layer.self_attn._get_input_buffer(state)
+            for key in ('prev_key', 'prev_value'):
+                self.assertEqual(buffer[key].size()[:2], (len(new_order), KV_HEADS))
+                self.assertEqual(buffer[key].size(3), EMBED_DIM // HEADS)
+
+    def test_head_count_mismatch(self):
+        model, _ = build_model(embed_dim=EMBED_DIM, heads=HEADS)
+        with self.assertRaisesRegex(ValueError, 'key/value heads'):
+            model.load_state_dict(copy.deepcopy(self.gqa_model.state_dict()))
+
+
+if __name__ == '__main__':
+    unittest.main()
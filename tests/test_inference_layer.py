@@ -0,0 +1,85 @@
+import copy
+import io
+import unittest
+
+import torch
+
+from models.joint import ProtectedTransformerDecoderLayer
+from tests.utils import build_model, dummy_batch
+
+
+def incremental_logits(model, src_tokens, src_lengths, prev_output_tokens):
+    encoder_out = model.encoder(src_tokens, src_lengths)
+    incremental_state = {}
+    logits = []
+    for step in range(prev_output_tokens.size(1)):
+        step_logits, _ = model.decoder(
+            prev_output_tokens[:, :step + 1], encoder_out, incremental_state=incremental_state)
+        logits.append(step_logits)
+    return torch.cat(logits, dim=1)
+
+
+class TestInferenceLayer(unittest.TestCase):
+
+    def _test_outputs(self, **kwargs):
+        model, d = build_model(**kwargs)
+        fast_model = copy.deepcopy(model)
+        fast_model.make_generation_fast_()
+        self.assertTrue(all(layer.fast_inference for layer in fast_model.decoder.layers))
+        batch = dummy_batch(d)
+        with torch.no_grad():
+            self.assertTrue(torch.allclose(model(*batch)[0], fast_model(*batch)[0], atol=1e-5))
+            self.assertTrue(torch.allclose(
+                incremental_logits(model, *batch), incremental_logits(fast_model, *batch), atol=1e-5))
+
+    def test_outputs(self):
+        self._test_outputs()
+
+    def test_outputs_normalize_before(self):
+        self._test_outputs(normalize_before=True)
+
+    def test_autograd_after_make_generation_fast(self):
+        model, d = build_model()
+        model.make_generation_fast_()
+        batch = dummy_batch(d)
+        # eval mode with autograd enabled uses the regular forward
+        logits, _ = model(*batch)
+        logits.sum().backward()
+        self.assertIsNotNone(model.decoder.layers[0].fc1.weight.grad)
+
+        # outputs of the fast path can be used by later autograd operations
+        with torch.no_grad():
+            logits, _ = model(*batch)
+        self.assertFalse(logits.is_inference())
+        weight = torch.ones(1, requires_grad=True)
+        (logits * weight).sum().backward()
+
+    def test_layer_trainable_after_make_generation_fast(self):
+        # fairseq disables train() on the model, the layers themselves are unchanged
+        model, _ = build_model(dropout=0.5)
+        layer = model.decoder.layers[0]
+        layer.make_generation_fast_()
+        self.assertIs(type(layer), ProtectedTransformerDecoderLayer)
+        layer.train()
+        x = torch.randn(5, 2, layer.embed_dim)
+        with torch.no_grad():
+            # dropout is applied in training
+            self.assertFalse(torch.equal(layer(x, None, None, None)[0], layer(x, None, None, None)[0]))
+
+    def test_pickle_layer(self):
+        model, _ = build_model()
+        layer = model.decoder.layers[0]
+        layer.make_generation_fast_()
+        x = torch.randn(5, 2, layer.embed_dim)
+        with torch.no_grad():
+            output, _ = layer(x, None, None, None)
+            f = io.BytesIO()
+            torch.save(layer, f)
+            f.seek(0)
+            reloaded = torch.load(f, weights_only=False)
+            self.assertTrue(reloaded.fast_inference)
+            self.assertTrue(torch.equal(reloaded(x, None, None, None)[0], output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+import argparse
+import contextlib
+import io
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.data import LanguagePairDataset
+
+from models.joint_translation import (
+    JointAttentionTranslationTask, LanguagePairsDataset, attention_cost, batch_by_attention_cost,
+    filter_by_attention_cost,
+)
+from tests.utils import build_model, dummy_dictionary
+
+
+def dummy_dataset(d, src_lengths, tgt_lengths, seed=None):
+    """Sentences of a repeated token, or of random tokens with *seed*."""
+    g = torch.Generator().manual_seed(seed) if seed is not None else None
+
+    def sentence(length):
+        if g is None:
+            tokens = torch.full((length,), d.nspecial, dtype=torch.long)
+        else:
+            tokens = torch.randint(d.nspecial, len(d), (length,), generator=g)
+        tokens[-1] = d.eos()
+        return tokens
+
+    return LanguagePairDataset(
+        [sentence(n) for n in src_lengths], np.array(src_lengths), d,
+        [sentence(n) for n in tgt_lengths], np.array(tgt_lengths), d,
+        shuffle=False,
+    )
+
+
+def padded_cost(batch, src_sizes, tgt_sizes):
+    return len(batch) * attention_cost(max(src_sizes[batch]), max(tgt_sizes[batch]))
+
+
+class TestBatchByAttentionCost(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.src_sizes = rng.randint(1, 40, size=200)
+        self.tgt_sizes = rng.randint(1, 40, size=200)
+        self.indices = np.argsort(self.src_sizes + self.tgt_sizes, kind='mergesort')
+
+    def test_batches(self):
+        max_cost = 20000
+        batches = batch_by_attention_cost(self.indices, self.src_sizes, self.tgt_sizes, max_cost)
+        # every index once, in order
+        self.assertEqual([i for batch in batches for i in batch], self.indices.tolist())
+        for i, batch in enumerate(batches):
+            self.assertLessEqual(padded_cost(batch, self.src_sizes, self.tgt_sizes), max_cost)
+            if i + 1 < len(batches):
+                # a batch is only closed when the next sentence does not fit
+                self.assertGreater(padded_cost(batch + batches[i + 1][:1], self.src_sizes, self.tgt_sizes), max_cost)
+
+    def test_max_sentences(self):
+        batches = batch_by_attention_cost(self.indices, self.src_sizes, self.tgt_sizes, 10 ** 9, max_sentences=16)
+        self.assertEqual([len(batch) for batch in batches], [16] * 12 + [8])
+
+    def test_required_batch_size_multiple(self):
+        batches = batch_by_attention_cost(
+            self.indices, self.src_sizes, self.tgt_sizes, 200000, required_batch_size_multiple=8)
+        self.assertGreater(len(batches), 2)
+        self.assertTrue(all(len(batch) % 8 == 0 for batch in batches[:-1]))
+
+    def test_oversize(self):
+        # the README value of --max-attention-cost allows up to 223 tokens on each side
+        src_sizes, tgt_sizes = np.array([10, 400, 20, 223]), np.array([10, 20, 400, 223])
+        indices = np.arange(4)
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            filtered = filter_by_attention_cost(indices, src_sizes, tgt_sizes, 150000)
+        self.assertEqual(filtered.tolist(), [0, 3])
+        self.assertIn('2 samples exceed --max-attention-cost', stdout.getvalue())
+        with self.assertRaisesRegex(Exception, 'skip-invalid-size-inputs-valid-test'):
+            filter_by_attention_cost(indices, src_sizes, tgt_sizes, 150000, raise_exception=True)
+
+
+class TestJointAttentionTranslationTask(unittest.TestCase):
+
+    def setUp(self):
+        self.d = dummy_dictionary()
+        args = argparse.Namespace(max_attention_cost=2000, lang_pairs=None, left_pad_source=True, left_pad_target=False)
+        self.task = JointAttentionTranslationTask(args, self.d, self.d)
+
+    def test_joint_length_order(self):
+        src_lengths, tgt_lengths = [9, 2, 5, 3, 8, 1], [1, 7, 5, 2, 8, 3]
+        dataset = dummy_dataset(self.d, src_lengths, tgt_lengths)
+        epoch_iter = self.task.get_batch_iterator(dataset, max_sentences=1)
+        order = [int(batch['id'][0]) for batch in epoch_iter.next_epoch_itr(shuffle=False)]
+        joint_lengths = [src_lengths[i] + tgt_lengths[i] for i in order]
+        self.assertEqual(sorted(order), list(range(len(src_lengths))))
+        self.assertEqual(joint_lengths, sorted(joint_lengths))
+
+    def test_oversize(self):
+        dataset = dummy_dataset(self.d, [5, 40, 6], [5, 40, 6])
+        with self.assertRaises(Exception):
+            self.task.get_batch_iterator(dataset)
+        with contextlib.redirect_stdout(io.StringIO()):
+            epoch_iter = self.task.get_batch_iterator(dataset, ignore_invalid_inputs=True)
+        ids = [int(i) for batch in epoch_iter.next_epoch_itr(shuffle=False) for i in batch['id']]
+        self.assertEqual(sorted(ids), [0, 2])
+
+
+class TestLanguagePairsDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.d = dummy_dictionary()
+        # (src_lang_id, tgt_lang_id) and sentence lengths of each language pair
+        self.lang_ids = [(0, 1), (2, 0), (1, 2)]
+        self.dataset = LanguagePairsDataset([
+            dummy_dataset(self.d, [4, 7, 2], [3, 5, 6], seed=0),
+            dummy_dataset(self.d, [6, 3], [4, 2], seed=1),
+            dummy_dataset(self.d, [5], [7], seed=2),
+        ], self.lang_ids)
+        self.pair_of_id = [0, 0, 0, 1, 1, 2]
+        self.batch = self.dataset.collater([self.dataset[i] for i in range(len(self.dataset))])
+
+    def test_collater(self):
+        net_input = self.batch['net_input']
+        ids = self.batch['id'].tolist()
+        # the collater sorts the sentences by source length
+        self.assertNotEqual(ids, sorted(ids))
+        for row, i in enumerate(ids):
+            self.assertEqual(
+                (net_input['src_lang_id'][row].item(), net_input['tgt_lang_id'][row].item()),
+                self.lang_ids[self.pair_of_id[i]],
+            )
+            src_tokens = net_input['src_tokens'][row]
+            self.assertTrue(torch.equal(src_tokens[src_tokens.ne(self.d.pad())], self.dataset[i]['source']))
+
+    def test_language_embeddings(self):
+        model, _ = build_model(self.d, language_embeddings=True, num_languages=3)
+        with torch.no_grad():
+            logits = model(**self.batch['net_input'])[0]
+            incremental = incremental_logits(model, **self.batch['net_input'])
+            for row, i in enumerate(self.batch['id'].tolist()):
+                alone = self.dataset.collater([self.dataset[i]])['net_input']
+                tgt_len = alone['prev_output_tokens'].size(1)
+                self.assertTrue(torch.allclose(logits[row, :tgt_len], model(**alone)[0][0], atol=1e-5))
+                self.assertTrue(torch.allclose(
+                    incremental[row, :tgt_len], incremental_logits(model, **alone)[0], atol=1e-5))
+                # the language of the sentence matters
+                alone['tgt_lang_id'] = (alone['tgt_lang_id'] + 1) % 3
+                self.assertFalse(torch.allclose(logits[row, :tgt_len], model(**alone)[0][0], atol=1e-5))
+
+
+def incremental_logits(model, src_tokens, src_lengths, prev_output_tokens, src_lang_id, tgt_lang_id):
+    encoder_out = model.encoder(src_tokens, src_lengths, src_lang_id=src_lang_id, tgt_lang_id=tgt_lang_id)
+    incremental_state = {}
+    logits = []
+    for step in range(prev_output_tokens.size(1)):
+        step_logits, _ = model.decoder(
+            prev_output_tokens[:, :step + 1], encoder_out, incremental_state=incremental_state)
+        logits.append(step_logits)
+    return torch.cat(logits, dim=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import torch
+
+from tests.utils import build_model, dummy_batch
+
+
+class TestPrefill(unittest.TestCase):
+
+    def _test_left_padded_prefix(self, **kwargs):
+        model, d = build_model(**kwargs)
+        src_tokens, src_lengths, tokens = dummy_batch(d, tgt_len=8)
+        prefix_lengths = [2, 5, 3]
+        num_steps = tokens.size(1) - max(prefix_lengths)
+
+        with torch.no_grad():
+            # full forward of each sentence on its own
+            expected = [
+                model(src_tokens[i:i + 1, -src_lengths[i]:], src_lengths[i:i + 1],
+                      tokens[i:i + 1, :prefix_lengths[i] + num_steps])[0][0, -num_steps - 1:]
+                for i in range(len(prefix_lengths))
+            ]
+
+            # left-padded prefixes in one prefill step, then one token per step
+            prefix = tokens.new_full((len(prefix_lengths), max(prefix_lengths)), d.pad())
+            for i, length in enumerate(prefix_lengths):
+                prefix[i, -length:] = tokens[i, :length]
+            encoder_out = model.encoder(src_tokens, src_lengths)
+            incremental_state = {}
+            logits = [model.decoder(prefix, encoder_out, incremental_state=incremental_state)[0][:, -1:]]
+            for step in range(num_steps):
+                next_tokens = torch.stack([tokens[i, length + step] for i, length in enumerate(prefix_lengths)])
+                prefix = torch.cat((prefix, next_tokens.unsqueeze(1)), dim=1)
+                logits.append(model.decoder(prefix, encoder_out, incremental_state=incremental_state)[0])
+            logits = torch.cat(logits, dim=1)
+
+        for i in range(len(prefix_lengths)):
+            self.assertTrue(torch.allclose(logits[i], expected[i], atol=1e-5), i)
+
+    def test_left_padded_prefix(self):
+        self._test_left_padded_prefix()
+
+    def test_left_padded_prefix_without_kernel_sizes(self):
+        self._test_left_padded_prefix(kernel_sizes=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'examples'))
+
+import prepare  # noqa: E402
+
+# Moses scripts used by the shell recipes, which clone mosesdecoder into examples/
+MOSES_SCRIPTS = os.environ.get('MOSES_SCRIPTS', os.path.join(ROOT, 'examples', 'mosesdecoder', 'scripts'))
+
+SAMPLES = {
+    'en': [
+        'Hello, world! This is a test -- isn\'t it?',
+        'Mr. Smith paid $1,000.50 (about 900 EUR) on 12/03/2014 at 5 p.m.',
+        '"Quoted" text with “smart quotes” and a well-known self-driving car.',
+        'URLs like http://www.example.com/a?b=c&d=e, e-mails like a.b@c.com | pipes.',
+        'Tabs\tand  multiple   spaces, <tags> & [brackets] {braces} … done.',
+        'Non​printing characters and – dashes — everywhere.',
+        'It\'s 25% off: 3.5 vs. 3,5 – U.S.A. and No. 7',
+    ],
+    'de': [
+        'Das ist ein Test, nicht wahr? Ja, z. B. am 3. Oktober.',
+        'Die Straße „Hauptstraße“ ist 1.000,5 km lang – unglaublich!',
+        'E-Mail-Adressen und Bindestrich-Komposita, ca. 20 % mehr.',
+        'Er sagte: ‚Nein‘ … und ging (wieder) nach Hause.',
+    ],
+    'fr': [
+        'C\'est l\'été ! Qu\'en pensez-vous ?',
+        '« Bonjour », dit-il ; M. Dupont a payé 1 000,50 €.',
+        'Aujourd\'hui, le porte-parole déclare : « non ».',
+        'Les Etats-Unis et l’Union européenne, etc.',
+    ],
+}
+
+
+def run_perl(script, args, lines):
+    result = subprocess.run(
+        ['perl', os.path.join(MOSES_SCRIPTS, script)] + args,
+        input=''.join(line + '\n' for line in lines).encode('utf-8'),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+    )
+    return result.stdout.decode('utf-8').split('\n')[:-1]
+
+
+def requires_moses(script):
+    return unittest.skipUnless(
+        shutil.which('perl') is not None and os.path.exists(os.path.join(MOSES_SCRIPTS, script)),
+        'set MOSES_SCRIPTS to the scripts directory of mosesdecoder ({} not found)'.format(script),
+    )
+
+
+class TestMosesParity(unittest.TestCase):
+    """prepare.py must produce the same output as the Moses perl scripts of
+    the shell recipes."""
+
+    @requires_moses('tokenizer/tokenizer.perl')
+    def test_tokenizer(self):
+        for lang, lines in SAMPLES.items():
+            for aggressive in (False, True):
+                expected = run_perl('tokenizer/tokenizer.perl', ['-q', '-l', lang] + (['-a'] if aggressive else []), lines)
+                self.assertEqual([prepare.process_line(line, lang, aggressive=aggressive) for line in lines], expected)
+
+    @requires_moses('tokenizer/normalize-punctuation.perl')
+    @requires_moses('tokenizer/remove-non-printing-char.perl')
+    def test_normalize_punctuation(self):
+        for lang, lines in SAMPLES.items():
+            expected = run_perl('tokenizer/remove-non-printing-char.perl', [],
+                                run_perl('tokenizer/normalize-punctuation.perl', ['-l', lang], lines))
+            self.assertEqual([prepare.remove_non_printing_char(prepare._normalizer(lang).normalize(line))
+                              for line in lines], expected)
+
+    @requires_moses('tokenizer/lowercase.perl')
+    def test_lowercase(self):
+        lines = [line for lang_lines in SAMPLES.values() for line in lang_lines]
+        expected = run_perl('tokenizer/lowercase.perl', [], lines)
+        self.assertEqual([prepare.process_line(line, None, lowercase=True) for line in lines], expected)
+
+    @requires_moses('training/clean-corpus-n.perl')
+    def test_clean_corpus(self):
+        src = [
+            'a short sentence', 'a b c d e f g h', '', 'one', 'x | y  z', ' padded   line ',
+            'ratio one two three', 'w' * 1001, 'ok then',
+        ]
+        tgt = [
+            'eine kurze satz', 'a b', 'empty source', 'eins', 'x y z', 'padded line',
+            'r', 'long word', '   ',
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, 'corpus')
+            prepare.write_lines(prefix + '.src', src)
+            prepare.write_lines(prefix + '.tgt', tgt)
+            subprocess.run(
+                ['perl', os.path.join(MOSES_SCRIPTS, 'training/clean-corpus-n.perl'), '-ratio', '1.5',
+                 prefix, 'src', 'tgt', os.path.join(tmp, 'perl'), '1', '6'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True,
+            )
+            prepare.clean_corpus(prefix, 'src', 'tgt', os.path.join(tmp, 'python'), ratio=1.5, min_len=1, max_len=6)
+            for lang in ('src', 'tgt'):
+                self.assertEqual(
+                    list(prepare.read_lines(os.path.join(tmp, 'python.' + lang))),
+                    list(prepare.read_lines(os.path.join(tmp, 'perl.' + lang))),
+                )
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_ordered_output(self):
+        lines = ['Line number {}, with punctuation!'.format(i) for i in range(100)]
+        expected = [prepare.process_line(line, 'en') for line in lines]
+        for workers in (1, 3):
+            pipeline = prepare.Pipeline(workers, chunk_size=7)
+            try:
+                self.assertEqual(list(pipeline.map(iter(lines), lang='en')), expected)
+            finally:
+                pipeline.close()
+
+    def test_bounded_read_ahead(self):
+        read = []
+
+        def lines():
+            for i in range(10000):
+                read.append(i)
+                yield 'line {}'.format(i)
+
+        pipeline = prepare.Pipeline(2, chunk_size=10, max_pending=3)
+        try:
+            outputs = pipeline.map(lines(), lang=None)
+            for _ in range(25):
+                next(outputs)
+            # the chunks being processed and the chunk being yielded
+            self.assertLessEqual(len(read), (3 + 3) * 10)
+            self.assertEqual(len(list(outputs)), 10000 - 25)
+        finally:
+            pipeline.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
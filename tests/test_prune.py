@@ -0,0 +1,115 @@
+import unittest
+
+import torch
+
+from models.joint import JointAttentionModel
+from prune import prune_state_dict, select_pruned
+from tests.utils import DummyTask, build_args, build_model, dummy_batch
+
+
+def gated_logits(model, batch, layers, heads):
+    """Logits of *model* with the head groups that are not in *heads* gated to
+    zero and the layers that are not in *layers* bypassed."""
+    def gate_heads(keep):
+        def hook(module, inputs):
+            x = inputs[0]
+            gate = torch.zeros(module_groups[module])
+            gate[keep] = 1
+            return (x.view(*x.size()[:-1], gate.numel(), -1) * gate.unsqueeze(-1)).view(x.size())
+        return hook
+
+    def bypass(module, inputs, output):
+        return inputs[0], output[1]
+
+    module_groups = {}
+    handles = []
+    for i, layer in enumerate(model.decoder.layers):
+        if i in layers:
+            module_groups[layer.self_attn.out_proj] = layer.self_attn.num_kv_heads
+            handles.append(layer.self_attn.out_proj.register_forward_pre_hook(
+                gate_heads(heads[layers.index(i)])))
+        else:
+            handles.append(layer.register_forward_hook(bypass))
+    try:
+        with torch.no_grad():
+            return model(*batch)[0]
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+class TestSelectPruned(unittest.TestCase):
+
+    def setUp(self):
+        self.head_importance = [
+            torch.Tensor([0.9, 0.1, 0.5, 0.2]),
+            torch.Tensor([0.3, 0.8, 0.05, 0.7]),
+            torch.Tensor([0.6, 0.4, 0.02, 0.01]),
+        ]
+        self.layer_importance = torch.Tensor([2.0, 0.5, 1.0])
+
+    def test_no_pruning(self):
+        layers, heads = select_pruned(self.head_importance, self.layer_importance, 0, 0)
+        self.assertEqual(layers, [0, 1, 2])
+        self.assertEqual(heads, [[0, 1, 2, 3]] * 3)
+
+    def test_least_important(self):
+        layers, heads = select_pruned(self.head_importance, self.layer_importance, 3, 1)
+        # layer 1 is removed first, its heads are not candidates
+        self.assertEqual(layers, [0, 2])
+        self.assertEqual(heads, [[0, 2, 3], [0, 1]])
+
+    def test_keep_one_head_per_layer(self):
+        layers, heads = select_pruned(self.head_importance, self.layer_importance, 6, 1)
+        self.assertEqual(layers, [0, 2])
+        self.assertEqual([len(h) for h in heads], [1, 1])
+        self.assertEqual(heads, [[0], [0]])
+        with self.assertRaises(AssertionError):
+            select_pruned(self.head_importance, self.layer_importance, 7, 1)
+        with self.assertRaises(AssertionError):
+            select_pruned(self.head_importance, self.layer_importance, 0, 3)
+
+
+class TestPruneStateDict(unittest.TestCase):
+
+    def prune(self, model, args, layers, heads):
+        """Load the pruned state dict as the smaller architecture and check
+        that it matches the gated model."""
+        pruned_state_dict, pruned_args = prune_state_dict(model.state_dict(), args, layers, heads)
+        pruned_model = JointAttentionModel.build_model(pruned_args, DummyTask(self.d))
+        pruned_model.load_state_dict(pruned_state_dict)
+        pruned_model.eval()
+        self.assertEqual(len(pruned_model.decoder.layers), len(layers))
+        for layer, kept in zip(pruned_model.decoder.layers, heads):
+            self.assertEqual(layer.self_attn.num_kv_heads, len(kept))
+        with torch.no_grad():
+            logits = pruned_model(*self.batch)[0]
+        self.assertTrue(torch.allclose(logits, gated_logits(model, self.batch, layers, heads), atol=1e-5))
+        return pruned_model, pruned_args
+
+    def check(self, **kwargs):
+        args = build_args(layers=4, **kwargs)
+        model, self.d = build_model(args=args)
+        self.batch = dummy_batch(self.d)
+        num_groups = args.decoder_kv_heads or args.decoder_attention_heads
+        model, args = self.prune(model, args, [0, 2, 3], [[0, 1], list(range(num_groups)), [num_groups - 1]])
+        self.assertEqual(args.kernel_size_list, [3, 7, 9])
+        # prune the pruned model again, its layers have different numbers of heads
+        self.prune(model, args, [0, 1], [[1], list(range(num_groups - 1))])
+
+    def test_prune(self):
+        self.check()
+
+    def test_gqa(self):
+        self.check(decoder_kv_heads=2)
+
+    def test_alignment_layer(self):
+        args = build_args(layers=4, alignment_layer=1)
+        model, self.d = build_model(args=args)
+        _, pruned_args = prune_state_dict(model.state_dict(), args, [0, 2, 3], [[0]] * 3)
+        self.assertEqual(pruned_args.alignment_layer, 0)
+        self.assertEqual(args.alignment_layer, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import sacrebleu
+
+import score
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ['a', 'I', 'is', 'the', 'cat', 'sat', 'on', 'mat', 'house', 'running', 'Haus', 'über', '.', ',']
+
+
+def random_sentences(n, seed=0, max_words=12):
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, max_words))) for _ in range(n)]
+
+
+class TestChrF(unittest.TestCase):
+
+    def assertMatchesSacrebleu(self, hyps, refs):
+        chrf = score.ChrFScorer()
+        for hyp, ref in zip(hyps, refs):
+            chrf.add(ref, hyp)
+        self.assertAlmostEqual(chrf.score(), sacrebleu.corpus_chrf(hyps, [refs]).score, places=6)
+
+    def test_corpus(self):
+        self.assertMatchesSacrebleu(random_sentences(200, seed=0), random_sentences(200, seed=1))
+
+    def test_short_references(self):
+        # references without n-grams of the higher orders
+        hyps = ['the cat sat on the mat', 'a house', 'running', 'I', '', 'is it']
+        refs = ['the cat', 'a', 'run', 'I is', 'a b', '']
+        self.assertMatchesSacrebleu(hyps, refs)
+        self.assertMatchesSacrebleu(random_sentences(200, seed=2), random_sentences(200, seed=3, max_words=2))
+
+    def test_sacrebleu_option(self):
+        hyps, refs = random_sentences(20, seed=4), random_sentences(20, seed=5)
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, lines in (('sys', hyps), ('ref', refs)):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.writelines(line + '\n' for line in lines)
+            output = subprocess.run(
+                [sys.executable, os.path.join(ROOT, 'score.py'), '--sys', os.path.join(tmp, 'sys'),
+                 '--ref', os.path.join(tmp, 'ref'), '--sacrebleu', '--chrf'],
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+            ).stdout.decode('utf-8')
+        self.assertIn(str(sacrebleu.corpus_chrf(hyps, [refs])), output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import os
+import socket
+import tempfile
+import unittest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from fairseq import checkpoint_utils, models, optim, options
+from fairseq.data import LanguagePairDataset
+from fairseq.tasks.translation import TranslationTask
+
+from tests.utils import dummy_dictionary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORLD_SIZE = 2
+NUM_STEPS = 3
+
+# fairseq checkpoints pickle the arguments, which PyTorch >= 2.6 doesn't load by default
+os.environ.setdefault('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')
+
+
+def get_args(extra_args=()):
+    from train_sharded import get_parser
+    return options.parse_args_and_arch(get_parser(), [
+        ROOT, '--user-dir', os.path.join(ROOT, 'models'), '--task', 'translation', '-s', 'de', '-t', 'en',
+        '--arch', 'joint_attention', '--decoder-layers', '3', '--kernel-size-list', '[3, 5, 7]',
+        '--encoder-embed-dim', '32', '--decoder-ffn-embed-dim', '64', '--decoder-attention-heads', '4',
+        '--share-all-embeddings', '--dropout', '0', '--attention-dropout', '0',
+        '--optimizer', 'adam', '--lr', '0.001', '--clip-norm', '0.1',
+        '--criterion', 'label_smoothed_cross_entropy', '--label-smoothing', '0.1',
+        '--max-tokens', '1000', '--cpu', '--distributed-world-size', str(WORLD_SIZE),
+    ] + list(extra_args))
+
+
+def get_samples(d, rank):
+    """NUM_STEPS batches of 8 sentence pairs, split between the workers."""
+    g = torch.Generator().manual_seed(0)
+
+    def sentence(length):
+        tokens = torch.randint(d.nspecial, len(d), (length,), generator=g)
+        tokens[-1] = d.eos()
+        return tokens
+
+    samples = []
+    for _ in range(NUM_STEPS):
+        src = [sentence(int(length)) for length in torch.randint(3, 12, (8,), generator=g)]
+        tgt = [sentence(int(length)) for length in torch.randint(3, 12, (8,), generator=g)]
+        dataset = LanguagePairDataset(
+            src, torch.tensor([len(s) for s in src]), d, tgt, torch.tensor([len(t) for t in tgt]), d)
+        samples.append(dataset.collater([dataset[i] for i in range(rank, 8, WORLD_SIZE)]))
+    return samples
+
+
+def train_step(task, model, criterion, optimizer, sample, args):
+    """The update of fairseq.trainer.Trainer.train_step, which needs CUDA with
+    more than one worker to gather the logging outputs."""
+    optimizer.zero_grad()
+    loss, sample_size, _ = task.train_step(sample, model, criterion, optimizer, False)
+    stats = torch.tensor([loss.item(), sample_size], dtype=torch.float64)
+    dist.all_reduce(stats)
+    optimizer.multiply_grads(args.distributed_world_size / float(stats[1]))
+    grad_norm = optimizer.clip_grad_norm(args.clip_norm)
+    optimizer.step()
+    return float(stats[0] / stats[1]), float(grad_norm)
+
+
+def run_worker(rank, port, sharded, output, extra_args=()):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=WORLD_SIZE)
+    from train_sharded import ShardedTrainer
+
+    args = get_args(extra_args)
+    args.distributed_rank = rank
+    d = dummy_dictionary()
+    task = TranslationTask(args, d, d)
+    samples = get_samples(d, rank)
+    torch.manual_seed(1)
+    model = task.build_model(args)
+    criterion = task.build_criterion(args)
+    result = {'losses': [], 'grad_norms': [], 'num_params': sum(p.numel() for p in model.parameters())}
+
+    if sharded:
+        trainer = ShardedTrainer(args, task, model, criterion)
+        wrapped_model, optimizer = trainer.model, trainer.optimizer
+        result['num_local_params'] = sum(p.numel() for p in wrapped_model.parameters())
+    else:
+        # replicated data parallel training as in the single-node recipes
+        args.ddp_backend = 'no_c10d'
+        wrapped_model = models.DistributedFairseqModel(args, model)
+        optimizer = optim.build_optimizer(args, list(model.parameters()))
+
+    for step, sample in enumerate(samples):
+        if sharded and step == NUM_STEPS - 1:
+            # save a checkpoint before the last update
+            trainer.consolidate_state_dicts()
+            trainer.save_checkpoint(output + '.pt', {'train_iterator': {'epoch': 1}, 'val_loss': None})
+        loss, grad_norm = train_step(task, wrapped_model, criterion, optimizer, sample, args)
+        result['losses'].append(loss)
+        result['grad_norms'].append(grad_norm)
+
+    if sharded:
+        trainer.consolidate_state_dicts()
+        result['model'] = trainer._consolidated_model_state_dict
+
+        # resume from the checkpoint and repeat the last update
+        dist.barrier()
+        torch.manual_seed(2)
+        resumed = ShardedTrainer(args, task, task.build_model(args), criterion)
+        resumed.load_checkpoint(output + '.pt')
+        loss, _ = train_step(task, resumed.model, criterion, resumed.optimizer, samples[-1], args)
+        result['resumed_loss'] = loss
+    else:
+        result['model'] = model.state_dict()
+
+    if rank == 0:
+        torch.save(result, output)
+    dist.destroy_process_group()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestShardedTraining(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            for name, sharded, extra_args in (('ddp', False, ()), ('sharded', True, ()), ('bf16', True, ('--bf16',))):
+                output = os.path.join(tmp, name)
+                mp.spawn(run_worker, args=(free_port(), sharded, output, extra_args), nprocs=WORLD_SIZE)
+                cls.results[name] = torch.load(output, weights_only=False)
+            cls.checkpoint = checkpoint_utils.load_checkpoint_to_cpu(os.path.join(tmp, 'sharded.pt'))
+
+    def test_matches_ddp(self):
+        ddp, sharded = self.results['ddp'], self.results['sharded']
+        for a, b in zip(ddp['losses'], sharded['losses']):
+            self.assertAlmostEqual(a, b, places=5)
+        for a, b in zip(ddp['grad_norms'], sharded['grad_norms']):
+            self.assertAlmostEqual(a, b, places=5)
+        self.assertEqual(ddp['model'].keys(), sharded['model'].keys())
+        for key, value in ddp['model'].items():
+            if key.endswith('_float_tensor'):  # uninitialized buffer of the sinusoidal positions
+                continue
+            self.assertTrue(torch.allclose(value, sharded['model'][key], atol=1e-6), key)
+
+    def test_bf16(self):
+        # bf16 parameters for the computation, fp32 master weights and gradient reduction
+        for a, b in zip(self.results['ddp']['losses'], self.results['bf16']['losses']):
+            self.assertAlmostEqual(a, b, places=2)
+
+    def test_parameters_are_sharded(self):
+        sharded = self.results['sharded']
+        self.assertLessEqual(sharded['num_local_params'], sharded['num_params'] // WORLD_SIZE + WORLD_SIZE)
+
+    def test_checkpoint(self):
+        # the checkpoint is a regular fairseq checkpoint of the unsharded model
+        args = get_args()
+        d = dummy_dictionary()
+        model = TranslationTask(args, d, d).build_model(args)
+        model.load_state_dict(self.checkpoint['model'], strict=True)
+        self.assertEqual(self.checkpoint['optimizer_history'][-1]['optimizer_name'], 'ShardedOptimizer')
+        # resuming restores the model and the optimizer state
+        self.assertAlmostEqual(self.results['sharded']['resumed_loss'], self.results['sharded']['losses'][-1], places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import argparse
+
+import torch
+
+from fairseq.data import Dictionary
+
+from models.joint import JointAttentionModel
+
+
+class DummyTask(object):
+
+    def __init__(self, dictionary):
+        self.source_dictionary = self.target_dictionary = dictionary
+
+
+def dummy_dictionary(vocab_size=50):
+    d = Dictionary()
+    for i in range(vocab_size):
+        d.add_symbol('w{}'.format(i))
+    return d
+
+
+def build_args(layers=3, embed_dim=32, heads=4, kernel_sizes=True, normalize_before=False, **kwargs):
+    """Arguments of a small joint attention model with shared embeddings and without dropout."""
+    args = argparse.Namespace(
+        left_pad_source=True, left_pad_target=False, decoder_layers=layers,
+        encoder_embed_dim=embed_dim, decoder_ffn_embed_dim=2 * embed_dim,
+        decoder_attention_heads=heads, share_all_embeddings=True,
+        decoder_normalize_before=normalize_before, tie_adaptive_weights=False,
+        dropout=0., attention_dropout=0., relu_dropout=0.,
+    )
+    if kernel_sizes:
+        args.kernel_size_list = ([3, 5, 7] + [9] * layers)[:layers]
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def build_model(dictionary=None, layers=3, embed_dim=32, heads=4, kernel_sizes=True,
+                normalize_before=False, seed=0, args=None, **kwargs):
+    """Small joint attention model with shared embeddings and without dropout,
+    or the model of *args*."""
+    torch.manual_seed(seed)
+    if dictionary is None:
+        dictionary = dummy_dictionary()
+    if args is None:
+        args = build_args(layers, embed_dim, heads, kernel_sizes, normalize_before, **kwargs)
+    model = JointAttentionModel.build_model(args, DummyTask(dictionary))
+    model.eval()
+    return model, dictionary
+
+
+def dummy_batch(dictionary, bsz=3, src_len=7, tgt_len=5, seed=1):
+    """Left-padded sources of decreasing lengths and target prefixes starting with eos."""
+    g = torch.Generator().manual_seed(seed)
+    src_tokens = torch.randint(dictionary.nspecial, len(dictionary), (bsz, src_len), generator=g)
+    src_lengths = torch.tensor([max(src_len - i, 1) for i in range(bsz)])
+    for i in range(bsz):
+        src_tokens[i, :src_len - src_lengths[i]] = dictionary.pad()
+    src_tokens[:, -1] = dictionary.eos()
+    prev_output_tokens = torch.randint(dictionary.nspecial, len(dictionary), (bsz, tgt_len), generator=g)
+    prev_output_tokens[:, 0] = dictionary.eos()
+    return src_tokens, src_lengths, prev_output_tokens
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3 -u
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Train a joint attention model with fully sharded data parallelism.
+
+fairseq 0.9 replicates the whole model on every worker (--ddp-backend c10d or
+no_c10d). This script runs the fairseq-train loop with a trainer that wraps
+the model with PyTorch's FullyShardedDataParallel instead: every decoder layer
+is a separate unit, so the parameters, the gradients and the optimizer state
+are sharded across the workers and each layer is only gathered while it is
+computed. It takes the arguments of fairseq-train (--ddp-backend is ignored)
+and writes regular, unsharded fairseq checkpoints.
+"""
+
+import functools
+import math
+import random
+
+import torch
+from torch.distributed.fsdp import (
+    FullOptimStateDictConfig, FullStateDictConfig, FullyShardedDataParallel, MixedPrecision, StateDictType,
+)
+from torch.distributed.fsdp.wrap import lambda_auto_wrap_policy
+
+from fairseq import checkpoint_utils, distributed_utils, options
+from fairseq.optim import FairseqOptimizer
+from fairseq.trainer import Trainer
+from fairseq_cli import train
+
+from models.joint import ProtectedTransformerDecoderLayer
+
+
+def get_parser():
+    parser = options.get_training_parser()
+    group = parser.add_argument_group('Sharded training')
+    # fmt: off
+    group.add_argument('--min-params-to-wrap', default=0, type=int, metavar='N',
+                       help='minimum number of parameters of a decoder layer to be sharded as a '
+                            'separate unit (default: every layer). Smaller units need less memory, '
+                            'but communicate in smaller messages')
+    group.add_argument('--bf16', action='store_true',
+                       help='compute and gather the parameters in bfloat16, the sharded master '
+                            'weights and the gradient reduction stay in fp32 (--fp16 is not supported)')
+    # fmt: on
+    return parser
+
+
+class ShardedOptimizer(FairseqOptimizer):
+    """Fairseq optimizer of the parameter shards of a
+    :class:`FullyShardedDataParallel` model.
+
+    The gradient norm is computed over all the shards, and the state dicts are
+    the consolidated optimizer states of the unsharded model, as saved in the
+    checkpoints.
+    """
+
+    def __init__(self, args, optimizer, model):
+        super().__init__(args)
+        self._optimizer = optimizer
+        self.model = model
+        self.consolidated_state_dict = None
+
+    @property
+    def optimizer(self):
+        return self._optimizer.optimizer
+
+    @property
+    def optimizer_config(self):
+        return self._optimizer.optimizer_config
+
+    def clip_grad_norm(self, max_norm):
+        # the local shards only have part of the gradient
+        return float(self.model.clip_grad_norm_(max_norm if max_norm > 0 else math.inf))
+
+    def consolidate_state_dict(self):
+        """Gather the optimizer state of all shards. Must be called on all workers."""
+        self.consolidated_state_dict = FullyShardedDataParallel.optim_state_dict(self.model, self.optimizer)
+
+    def state_dict(self):
+        assert self.consolidated_state_dict is not None, 'consolidate_state_dict() has to be called first'
+        return self.consolidated_state_dict
+
+    def load_state_dict(self, state_dict, optimizer_overrides=None):
+        state_dict = FullyShardedDataParallel.optim_state_dict_to_load(self.model, self.optimizer, state_dict)
+        self._optimizer.load_state_dict(state_dict, optimizer_overrides)
+
+    def step(self, closure=None):
+        self._optimizer.step(closure)
+
+    def zero_grad(self):
+        self._optimizer.zero_grad()
+
+
+class ShardedTrainer(Trainer):
+    """:class:`fairseq.trainer.Trainer` with the model wrapped with
+    :class:`FullyShardedDataParallel` on more than one worker.
+
+    The model is wrapped the first time it is used after loading the last
+    checkpoint, so checkpoints are loaded into the unsharded model.
+    """
+
+    def __init__(self, args, task, model, criterion, dummy_batch=None, oom_batch=None):
+        if args.fp16:
+            raise ValueError('--fp16 is not supported with sharded training, use --bf16')
+        super().__init__(args, task, model, criterion, dummy_batch=dummy_batch, oom_batch=oom_batch)
+        self._consolidated_model_state_dict = None
+
+    @property
+    def sharded(self):
+        return self.args.distributed_world_size > 1
+
+    @property
+    def model(self):
+        if self._wrapped_model is None:
+            if not self.sharded:
+                return super().model
+            mixed_precision = MixedPrecision(
+                param_dtype=torch.bfloat16, reduce_dtype=torch.float32, buffer_dtype=torch.bfloat16,
+            ) if self.args.bf16 else None
+            self._wrapped_model = FullyShardedDataParallel(
+                self._model,
+                auto_wrap_policy=functools.partial(lambda_auto_wrap_policy, lambda_fn=self.wrap_layer),
+                mixed_precision=mixed_precision,
+                device_id=torch.cuda.current_device() if self.cuda else torch.device('cpu'),
+                # all workers build the model with the same seed, the broadcast
+                # is only a safeguard and needs CUDA
+                sync_module_states=self.cuda,
+            )
+        return self._wrapped_model
+
+    def wrap_layer(self, module):
+        """Shard each decoder layer with enough parameters as a separate unit."""
+        return isinstance(module, ProtectedTransformerDecoderLayer) and \
+            sum(p.numel() for p in module.parameters()) >= self.args.min_params_to_wrap
+
+    def _build_optimizer(self):
+        super()._build_optimizer()
+        if self.sharded:
+            self._optimizer = ShardedOptimizer(self.args, self._optimizer, self.model)
+
+    def consolidate_state_dicts(self):
+        """Gather the full model and optimizer states for :func:`save_checkpoint`.
+        Must be called on all workers."""
+        if not self.sharded:
+            return
+        with FullyShardedDataParallel.state_dict_type(
+            self.model, StateDictType.FULL_STATE_DICT,
+            FullStateDictConfig(offload_to_cpu=True, rank0_only=True),
+            FullOptimStateDictConfig(offload_to_cpu=True, rank0_only=True),
+        ):
+            self._consolidated_model_state_dict = self.model.state_dict()
+            self.optimizer.consolidate_state_dict()
+
+    def save_checkpoint(self, filename, extra_state):
+        """Save all training state in a checkpoint file."""
+        if not self.sharded:
+            return super().save_checkpoint(filename, extra_state)
+        if distributed_utils.is_master(self.args):  # only save one checkpoint
+            extra_state["train_meters"] = self.meters
+            checkpoint_utils.save_state(
+                filename,
+                self.args,
+                self._consolidated_model_state_dict,
+                self.get_criterion(),
+                self.optimizer,
+                self.lr_scheduler,
+                self.get_num_updates(),
+                self._optim_history,
+                extra_state,
+            )
+
+    def load_checkpoint(self, *args, **kwargs):
+        assert self._wrapped_model is None or not self.sharded, \
+            'checkpoints have to be loaded before the model is sharded'
+        return super().load_checkpoint(*args, **kwargs)
+
+
+_save_checkpoint = checkpoint_utils.save_checkpoint
+
+
+def save_checkpoint(args, trainer, epoch_itr, val_loss):
+    # fairseq only calls the trainer on the master, but gathering the full
+    # state dicts needs all the workers
+    if not args.no_save:
+        trainer.consolidate_state_dicts()
+    _save_checkpoint(args, trainer, epoch_itr, val_loss)
+
+
+def main(args, init_distributed=False):
+    train.Trainer = ShardedTrainer
+    checkpoint_utils.save_checkpoint = save_checkpoint
+    train.main(args, init_distributed=init_distributed)
+
+
+def distributed_main(i, args, start_rank=0):
+    args.device_id = i
+    if args.distributed_rank is None:  # torch.multiprocessing.spawn
+        args.distributed_rank = start_rank + i
+    main(args, init_distributed=True)
+
+
+def cli_main():
+    parser = get_parser()
+    args = options.parse_args_and_arch(parser)
+
+    if args.distributed_init_method is None:
+        distributed_utils.infer_init_method(args)
+
+    if args.distributed_init_method is not None:
+        # distributed training, e.g. one process per GPU started by srun
+        if torch.cuda.device_count() > 1 and not args.distributed_no_spawn:
+            start_rank = args.distributed_rank
+            args.distributed_rank = None  # assign automatically
+            torch.multiprocessing.spawn(
+                fn=distributed_main,
+                args=(args, start_rank),
+                nprocs=torch.cuda.device_count(),
+            )
+        else:
+            distributed_main(args.device_id, args)
+    elif args.distributed_world_size > 1:
+        # single node with multiple GPUs
+        assert args.distributed_world_size <= torch.cuda.device_count()
+        port = random.randint(10000, 20000)
+        args.distributed_init_method = 'tcp://localhost:{port}'.format(port=port)
+        args.distributed_rank = None  # set based on device id
+        torch.multiprocessing.spawn(
+            fn=distributed_main,
+            args=(args, ),
+            nprocs=args.distributed_world_size,
+        )
+    else:
+        # single GPU training, nothing to shard
+        main(args)
+
+
+if __name__ == '__main__':
+    cli_main()
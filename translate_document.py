@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in
+# the root directory of this source tree. An additional grant of patent rights
+# can be found in the PATENTS file in the same directory.
+"""
+Translate long documents in overlapping chunks with bounded memory.
+
+The input has one tokenized sentence per line, with an empty line between
+documents. The translation of each document is printed on a single line. See
+models/document_translation.py for the chunking.
+"""
+
+import fileinput
+
+import torch
+
+from fairseq import checkpoint_utils, options, tasks, utils
+from fairseq.meters import StopwatchMeter
+
+from models.document_translation import DocumentTranslator
+
+
+def get_parser():
+    parser = options.get_generation_parser(interactive=True)
+    group = parser.add_argument_group('Document translation')
+    # fmt: off
+    group.add_argument('--chunk-tokens', default=200, type=int, metavar='N',
+                       help='maximum number of source tokens translated in a chunk')
+    group.add_argument('--chunk-overlap', default=0, type=int, metavar='N',
+                       help='number of source tokens of each neighbouring chunk added as context, '
+                            'for models trained on consecutive sentences (default: 0)')
+    group.add_argument('--target-carry', action='store_true',
+                       help='continue the translation of the previous chunk instead of translating '
+                            'the chunks independently, for models trained on consecutive sentences '
+                            'with --kernel-size-list. The target positions continue across chunks '
+                            'up to the maximum target positions, then start over')
+    group.add_argument('--source-lang-id', type=int, metavar='N',
+                       help='source language id of a model with --num-languages (its position in '
+                            '--langs of the joint_attention_translation task)')
+    group.add_argument('--target-lang-id', type=int, metavar='N',
+                       help='target language id of a model with --num-languages')
+    # fmt: on
+    return parser
+
+
+def read_documents(input):
+    """Yield the documents of *input* as lists of sentences."""
+    document = []
+    for line in fileinput.input([input], openhook=fileinput.hook_encoded('utf-8')):
+        line = line.strip()
+        if len(line) == 0:
+            if len(document) > 0:
+                yield document
+            document = []
+        else:
+            document.append(line)
+    if len(document) > 0:
+        yield document
+
+
+def main(args):
+    assert args.path is not None, '--path required for translation!'
+    assert len(args.path.split(':')) == 1, 'ensembles are not supported'
+    assert (args.source_lang_id is None) == (args.target_lang_id is None), \
+        '--source-lang-id and --target-lang-id must be given together'
+
+    utils.import_user_module(args)
+    print(args)
+
+    use_cuda = torch.cuda.is_available() and not args.cpu
+
+    task = tasks.setup_task(args)
+    src_dict, tgt_dict = task.source_dictionary, task.target_dictionary
+
+    # Load the model
+    print('| loading model from {}'.format(args.path))
+    models, _model_args = checkpoint_utils.load_model_ensemble(
+        [args.path], arg_overrides=eval(args.model_overrides), task=task,
+    )
+    model = models[0]
+    model.make_generation_fast_()
+    if args.fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    model.eval()
+
+    translator = DocumentTranslator(
+        model, tgt_dict, chunk_tokens=args.chunk_tokens, overlap=args.chunk_overlap,
+        carry_target=args.target_carry,
+        max_len_a=args.max_len_a, max_len_b=args.max_len_b,
+    )
+
+    timer = StopwatchMeter()
+    num_documents = num_chunks = 0
+    for i, document in enumerate(read_documents(args.input)):
+        sentences = [src_dict.encode_line(sentence, add_if_not_exist=False).long() for sentence in document]
+        timer.start()
+        tokens = translator.translate(sentences, args.source_lang_id, args.target_lang_id)
+        timer.stop(tokens.numel())
+        num_documents += 1
+        num_chunks += len(list(translator.chunks(sentences)))
+        print('D-{}\t{}'.format(i, tgt_dict.string(tokens, args.remove_bpe)))
+
+    print('| translated {} documents ({} chunks, {} tokens) in {:.1f}s ({:.2f} tokens/s), '
+          'at most {} cached positions'.format(
+              num_documents, num_chunks, timer.n, timer.sum, timer.n / timer.sum if timer.sum > 0 else 0.,
+              translator.max_cached_positions))
+
+
+def cli_main():
+    parser = get_parser()
+    args = options.parse_args_and_arch(parser)
+    main(args)
+
+
+if __name__ == '__main__':
+    cli_main()